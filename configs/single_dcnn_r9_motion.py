@@ -5,25 +5,49 @@ model = dict(
         type='ResNet',
         depth=9,
         in_channels=1,
-        out_channels=256,
+        out_channels=1,
+        base_channels=64,
         padding_type='reflect',
         upsampling='bilinear'),
+    loss='L1',
 )
 # model training and testing settings
 train_cfg = dict()
-test_cfg = dict()
+test_cfg = dict()  # dict(tile_cfg=dict(tile_size=512, overlap=64)) for large slices
 # dataset settings
 dataset_type = 'CocoDataset'
 data_root = 'data/coco/'
 train_pipeline = [
     dict(type='LoadDicomFromFile'),
+    dict(type='RandomCrop', crop_size=256),
+    dict(type='TargetFromMotion'),
+    dict(type='NormalizeInstance'),
+    dict(type='SliceToTensor', keys=['input', 'target']),
+    dict(type='Collect', keys=['input', 'target']),
 ]
+# tools/test.py: blurred input against the original slice
+eval_pipeline = [
+    dict(type='LoadDicomFromFile'),
+    dict(type='TargetFromMotion', invariant_prob=0.),
+    dict(type='NormalizeInstance'),
+    dict(type='Pad', size_divisor=4),
+    dict(type='SliceToTensor', keys=['input', 'target']),
+    dict(type='Collect', keys=['input', 'target'], meta_keys=('filename', 'ori_shape', 'norm_cfg', 'target_norm_cfg')),
+]
+# tools/infer_series.py: the slice as it is
 test_pipeline = [
     dict(type='LoadDicomFromFile'),
+    dict(type='NormalizeInstance'),
+    dict(type='Pad', size_divisor=4),
+    dict(type='SliceToTensor', keys=['input']),
+    dict(type='Collect', keys=['input']),
 ]
 data = dict(
     imgs_per_gpu=2,
     workers_per_gpu=2,
+    pin_memory=True,
+    prefetch=2,
+    persistent_workers=True,
     train=dict(
         type=dataset_type,
         ann_file='coco_train.json',
@@ -33,10 +57,15 @@ data = dict(
         type=dataset_type,
         ann_file='coco_test.json',
         data_root=data_root,
-        pipeline=test_pipeline)
+        pipeline=eval_pipeline)
 )
 # optimizer
-
+optimizer = dict(type='Adam', lr=1e-4, betas=(0.5, 0.999))
+accumulate = 1
 # learning policy
-
+total_epochs = 12
 # runtime settings
+amp_cfg = dict()  # dict(dtype='bfloat16') for autocast
+checkpoint_config = dict(interval=1)
+log_config = dict(interval=50)
+work_dir = 'work_dirs/single_dcnn_r9_motion'
@@ -1,4 +1,5 @@
 from .coco import CocoDataset
-from .registry import DATASETS
+from .registry import DATASETS, BATCH_PIPELINES
+from .shard import ShardDataset
 
-__all__ = ['CocoDataset', 'DATASETS']
+__all__ = ['CocoDataset', 'DATASETS', 'BATCH_PIPELINES', 'ShardDataset']
@@ -1,23 +1,185 @@
+import os
 import json
+import hashlib
+import logging
+import itertools
 import numpy as np
 import os.path as osp
-from collections import defaultdict
+import pycocotools.mask as maskUtils
+from multiprocessing import Pool
 from .pipelines import Compose
+from .pipelines.masks import to_rle
 from .registry import DATASETS
 
+'''
+The annotation index is columnar: a handful of numpy arrays instead of
+millions of small python objects. Forked DataLoader workers only read
+these buffers, so refcount updates no longer unshare copy-on-write pages.
+Polygons are flat float64 coordinates with part / annotation offsets,
+compressed RLE counts one byte blob with offsets.
+
+With `rle_cfg`, polygons and uncompressed RLE are converted to compressed
+RLE once and kept in `<ann_file>.rle.npz`, keyed by the sha1 of the json.
+'''
+
+
+def to_offsets(lengths):
+    return np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(lengths, dtype=np.int64)])
+
+
+class StringArray(object):
+
+    def __init__(self, strings):
+        encoded = [s.encode('utf-8') for s in strings]
+        self.offsets = to_offsets(np.fromiter(map(len, encoded), np.int64, len(encoded)))
+        self.blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.blob[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode('utf-8')
+
+
+class SegmArray(object):
+    # one segmentation per annotation: a polygon (list of float64 parts) or a
+    # compressed RLE dict(size=[h, w], counts=bytes); uncompressed RLE is
+    # compressed when the array is built
+    fields = ('is_rle', 'sizes', 'counts_blob', 'counts_offsets', 'coords', 'part_offsets', 'ann_parts')
+
+    def __init__(self, segms):
+        n = len(segms)
+        self.is_rle = np.zeros(n, dtype=bool)
+        self.sizes = np.zeros((n, 2), dtype=np.int32)
+        num_parts = np.zeros(n, dtype=np.int64)
+        counts = [b''] * n
+        parts = []
+        for i, segm in enumerate(segms):
+            if isinstance(segm, list):
+                num_parts[i] = len(segm)
+                parts.extend(segm)
+                continue
+            if isinstance(segm['counts'], list):
+                segm = maskUtils.frPyObjects(segm, *segm['size'])
+            c = segm['counts']
+            counts[i] = c.encode('ascii') if isinstance(c, str) else c
+            self.is_rle[i] = True
+            self.sizes[i] = segm['size']
+
+        self.counts_offsets = to_offsets(np.fromiter(map(len, counts), np.int64, n))
+        self.counts_blob = np.frombuffer(b''.join(counts), dtype=np.uint8)
+        self.ann_parts = to_offsets(num_parts)
+        self.part_offsets = to_offsets(np.fromiter(map(len, parts), np.int64, len(parts)))
+        self.coords = np.fromiter(itertools.chain.from_iterable(parts), np.float64, int(self.part_offsets[-1]))
+
+    @classmethod
+    def from_buffers(cls, **buffers):
+        segms = cls([])
+        for k in cls.fields:
+            setattr(segms, k, buffers[k])
+        return segms
+
+    def buffers(self):
+        return {k: getattr(self, k) for k in self.fields}
+
+    def __len__(self):
+        return len(self.is_rle)
+
+    def __getitem__(self, idx):
+        if self.is_rle[idx]:
+            counts = self.counts_blob[self.counts_offsets[idx]:self.counts_offsets[idx + 1]].tobytes()
+            return dict(size=self.sizes[idx].tolist(), counts=counts)
+        offsets = self.part_offsets
+        return [self.coords[offsets[k]:offsets[k + 1]] for k in range(self.ann_parts[idx], self.ann_parts[idx + 1])]
+
+
+class CocoIndex(object):
+
+    def __init__(self, coco):
+        images = coco['images']
+        self.img_ids = np.array([img['id'] for img in images], dtype=np.int64)
+        self.heights = np.array([img.get('height', 0) for img in images], dtype=np.int32)
+        self.widths = np.array([img.get('width', 0) for img in images], dtype=np.int32)
+        self.filenames = StringArray([img['file_name'] for img in images])
+
+        # group annotations by image, keeping json order within an image
+        anns = coco['annotations']
+        img_inds = {img_id: i for i, img_id in enumerate(self.img_ids.tolist())}
+        pos = np.array([img_inds.get(ann['image_id'], -1) for ann in anns], dtype=np.int64)
+
+        order = np.flatnonzero(pos >= 0)
+        order = order[np.argsort(pos[order], kind='stable')]
+        counts = np.bincount(pos[order], minlength=len(images))
+        self.ann_offsets = np.concatenate([np.zeros(1, dtype=np.int64), np.cumsum(counts)])
+
+        boxes = np.fromiter(itertools.chain.from_iterable(anns[i]['bbox'] for i in order), np.float32,
+                            4 * len(order)).reshape(-1, 4)
+        boxes[:, 2:] += boxes[:, :2] - 1
+        self.boxes = boxes
+        self.segms = SegmArray([anns[i]['segmentation'] for i in order])
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def img_info(self, idx):
+        filename = self.filenames[idx]
+        return dict(id=int(self.img_ids[idx]), file_name=filename, filename=filename,
+                    height=int(self.heights[idx]), width=int(self.widths[idx]))
+
+    def ann_range(self, idx):
+        return int(self.ann_offsets[idx]), int(self.ann_offsets[idx + 1])
+
+
+def _encode_segms(args):
+    segms, heights, widths = args
+    encoded = []
+    for segm, h, w in zip(segms, heights, widths):
+        if h > 0 and w > 0:
+            segm = to_rle(segm, h, w)
+        encoded.append(segm)
+    return encoded
+
+
+def encode_segms(index, nproc=1, chunk_size=4096):
+    # image size of every annotation, annotations are grouped by image
+    counts = np.diff(index.ann_offsets)
+    heights = np.repeat(index.heights, counts).tolist()
+    widths = np.repeat(index.widths, counts).tolist()
+    num = len(index.segms)
+
+    chunks = (([index.segms[j] for j in range(i, min(i + chunk_size, num))], heights[i:i + chunk_size],
+               widths[i:i + chunk_size]) for i in range(0, num, chunk_size))
+    if nproc > 1 and num > chunk_size:
+        with Pool(nproc) as pool:
+            encoded = pool.map(_encode_segms, chunks)
+    else:
+        encoded = [_encode_segms(chunk) for chunk in chunks]
+    return SegmArray([segm for chunk in encoded for segm in chunk])
+
+
+def file_sha1(filename, block_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
 
 @DATASETS.register_module
 class CocoDataset(object):
 
-    def __init__(self, ann_file, data_root, pipeline):
+    def __init__(self, ann_file, data_root, pipeline, profile_interval=0, rle_cfg=None):
         self.ann_file = ann_file
         self.data_root = data_root
-        self.pipeline = Compose(pipeline)
+        self.pipeline = Compose(pipeline, profile_interval)
+        self.rle_cfg = rle_cfg
 
         if self.data_root is not None:
             self.ann_file = osp.join(self.data_root, self.ann_file)
 
         self.dataset = self.load_annotations(self.ann_file)
+        if rle_cfg is not None:
+            self.dataset.segms = self.load_rles(self.ann_file, **rle_cfg)
 
     def __len__(self):
         return len(self.dataset)
@@ -33,34 +195,46 @@ class CocoDataset(object):
     def load_annotations(self, ann_file):
         with open(ann_file, 'r') as f:
             coco = json.load(f)
+        return CocoIndex(coco)
+
+    def load_rles(self, ann_file, nproc=1, cache=True):
+        key = file_sha1(ann_file)
+        cache_file = ann_file + '.rle.npz'
+        if cache and osp.exists(cache_file):
+            try:
+                with np.load(cache_file) as cached:
+                    if cached['key'].item() == key:
+                        return SegmArray.from_buffers(**{k: cached[k] for k in SegmArray.fields})
+            except (OSError, ValueError, KeyError):
+                pass
+
+        segms = encode_segms(self.dataset, nproc)
+        if cache:
+            tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+            try:
+                with open(tmp_file, 'wb') as f:
+                    np.savez(f, key=np.array(key), **segms.buffers())
+                os.replace(tmp_file, cache_file)
+            except OSError as e:
+                logging.getLogger().warning('{}: rle cache not written, {}'.format(self.__class__.__name__, e))
+                if osp.exists(tmp_file):
+                    os.remove(tmp_file)
+        return segms
+
+    def get_img_shapes(self):
+        return np.stack([self.dataset.heights, self.dataset.widths], axis=1)
+
+    def parse_ann_info(self, idx):
+        start, end = self.dataset.ann_range(idx)
 
-        img2anns = defaultdict(list)
-        for ann in coco['annotations']:
-            img2anns[ann['image_id']].append(ann)
-
-        dataset = []
-        for img in coco['images']:
-            img['filename'] = img['file_name']
-            dataset.append((img, img2anns[img['id']]))
-        return dataset
-
-    def parse_ann_info(self, ann_info):
-        gt_boxes = []
-        gt_masks_ann = []
-        for ann in ann_info:
-            x, y, w, h = ann['bbox']
-            gt_boxes.append([x, y, x + w - 1, y + h - 1])
-            gt_masks_ann.append(ann['segmentation'])
-
-        if gt_boxes:
-            gt_boxes = np.array(gt_boxes, dtype=np.float32)
-        else:
-            gt_boxes = np.zeros((0, 4), dtype=np.float32)
+        # copy, transforms adjust boxes in place
+        gt_boxes = self.dataset.boxes[start:end].copy()
+        gt_masks_ann = [self.dataset.segms[i] for i in range(start, end)]
 
         return dict(boxes=gt_boxes, masks=gt_masks_ann)
 
     def prepare_train(self, idx):
-        img_info, ann_info = self.dataset[idx]
-        ann_info = self.parse_ann_info(ann_info)
+        img_info = self.dataset.img_info(idx)
+        ann_info = self.parse_ann_info(idx)
         results = dict(data_root=self.data_root, img_info=img_info, ann_info=ann_info)
         return self.pipeline(results)
@@ -1,3 +1,6 @@
 from .build_loader import build_dataloader
+from .prefetch_loader import PrefetchLoader, batch_to_device
+from .sampler import BucketBatchSampler, DistributedSampler, get_dist_info
 
-__all__ = ['build_dataloader']
+__all__ = ['build_dataloader', 'PrefetchLoader', 'batch_to_device', 'BucketBatchSampler',
+           'DistributedSampler', 'get_dist_info']
@@ -1,48 +1,136 @@
 import re
 import torch
-from torch.utils.data import DataLoader
-from torch._six import container_abcs, string_classes, int_classes
+import numpy as np
+from torch.utils.data import DataLoader, get_worker_info
+from collections import abc
+from ..pipelines import BatchCompose
+from .prefetch_loader import PrefetchLoader
+from .sampler import BucketBatchSampler, DistributedSampler, get_dist_info
 
 np_str_obj_array_pattern = re.compile(r'[SaUO]')
 
 error_msg_fmt = 'batch must contain tensors, numbers, dicts or lists; found {}'
 
 
-def default_collate(batch):
+# samples of these keys may differ in their last two (spatial) dims, they are
+# padded to the largest one; other keys of different shape (e.g. gt_boxes,
+# gt_masks with a different number of instances) stay lists of tensors
+pad_keys = ('input', 'target')
+
+
+def new_shared(elem, shape):
+    # as torch's default_collate: the batch is written straight into shared
+    # memory, it then reaches the main process without the copy of pickling
+    numel = int(np.prod(shape))
+    if hasattr(elem, '_typed_storage'):
+        storage = elem._typed_storage()._new_shared(numel, device=elem.device)
+    else:
+        storage = elem.storage()._new_shared(numel)
+    return elem.new(storage).resize_(*shape)
+
+
+def collate_tensors(batch, key=None, pad_value=0):
+    elem = batch[0]
+    shape = tuple(elem.shape)
+    if all(tuple(b.shape) == shape for b in batch):
+        out = new_shared(elem, (len(batch),) + shape) if get_worker_info() is not None else None
+        return torch.stack(batch, 0, out=out)
+
+    if key not in pad_keys:
+        return list(batch)
+    if any(b.dim() != elem.dim() or tuple(b.shape[:-2]) != shape[:-2] for b in batch):
+        raise ValueError('{} can only differ in its last two dims, got {}'.format(
+            key, [tuple(b.shape) for b in batch]))
+
+    shape = (len(batch),) + shape[:-2] + tuple(max(sizes) for sizes in zip(*[b.shape[-2:] for b in batch]))
+    out = new_shared(elem, shape) if get_worker_info() is not None else elem.new_empty(shape)
+    out.fill_(pad_value)
+    for i, b in enumerate(batch):
+        out[i, ..., :b.size(-2), :b.size(-1)].copy_(b)
+    return out
+
+
+def default_collate(batch, key=None):
     elem_type = type(batch[0])
     if isinstance(batch[0], torch.Tensor):
-        return torch.stack(batch, 0)
+        return collate_tensors(batch, key)
     elif elem_type.__module__ == 'numpy' and elem_type.__name__ == 'ndarray':
         elem_type_ = batch[0].dtype
         if np_str_obj_array_pattern.search(elem_type_.str) is not None:
             raise TypeError(error_msg_fmt.format(elem_type_))
 
-        return default_collate([torch.from_numpy(b) for b in batch])
+        return collate_tensors([torch.from_numpy(b) for b in batch], key)
     elif isinstance(batch[0], float):
         return torch.tensor(batch)
-    elif isinstance(batch[0], int_classes):
+    elif isinstance(batch[0], int):
         return torch.tensor(batch)
-    elif isinstance(batch[0], string_classes):
+    elif isinstance(batch[0], str):
         return batch
-    elif isinstance(batch[0], container_abcs.Mapping):
+    elif isinstance(batch[0], abc.Mapping):
         if batch[0].get('cpu_only', False):
             return {key: [d[key] for d in batch] for key in batch[0]}
         else:
-            return {key: default_collate([d[key] for d in batch]) for key in batch[0]}
+            return {key: default_collate([d[key] for d in batch], key) for key in batch[0]}
 
     raise TypeError(error_msg_fmt.format(type(batch[0])))
 
 
-def build_dataloader(dataset, imgs_per_gpu, workers_per_gpu, num_gpus=1, shuffle=True, **kwargs):
-    batch_size = num_gpus * imgs_per_gpu
-    num_workers = num_gpus * workers_per_gpu
+class BatchPipelineLoader(object):
+
+    def __init__(self, data_loader, pipeline):
+        self.data_loader = data_loader
+        self.pipeline = pipeline
+
+    def __getattr__(self, name):
+        return getattr(self.data_loader, name)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        for batch in self.data_loader:
+            yield self.pipeline(batch)
+
+
+def build_dataloader(dataset, imgs_per_gpu, workers_per_gpu, num_gpus=1, dist=False, shuffle=True,
+                     batch_pipeline=None, pin_memory=False, prefetch=0, device='cuda', persistent_workers=False,
+                     bucket_cfg=None, seed=0, **kwargs):
+    if dist:
+        # one process per gpu, each reads only its own share of the dataset
+        rank, world_size = get_dist_info()
+        batch_size = imgs_per_gpu
+        num_workers = workers_per_gpu
+    else:
+        rank, world_size = 0, 1
+        batch_size = num_gpus * imgs_per_gpu
+        num_workers = num_gpus * workers_per_gpu
+
+    use_cuda = torch.device(device).type == 'cuda' and torch.cuda.is_available()
+    if num_workers > 0:
+        kwargs.setdefault('persistent_workers', persistent_workers)
+
+    # group images of the same padded shape into batches
+    if bucket_cfg is not None:
+        kwargs['batch_sampler'] = BucketBatchSampler(dataset, batch_size, shuffle=shuffle, seed=seed,
+                                                     num_replicas=world_size, rank=rank, **bucket_cfg)
+    elif dist:
+        kwargs.update(batch_size=batch_size,
+                      sampler=DistributedSampler(dataset, world_size, rank, shuffle=shuffle, seed=seed))
+    else:
+        kwargs.update(batch_size=batch_size, shuffle=shuffle)
 
     data_loader = DataLoader(dataset,
-                             batch_size=batch_size,
-                             shuffle=shuffle,
                              num_workers=num_workers,
                              collate_fn=default_collate,
-                             pin_memory=False,
+                             pin_memory=pin_memory and use_cuda,
                              **kwargs)
 
+    # copy batches to the device ahead of use
+    if prefetch > 0:
+        data_loader = PrefetchLoader(data_loader, device, prefetch)
+
+    # transforms on the collated batch, in the main process
+    if batch_pipeline is not None:
+        data_loader = BatchPipelineLoader(data_loader, BatchCompose(batch_pipeline))
+
     return data_loader
@@ -0,0 +1,71 @@
+import torch
+from collections import abc, deque
+
+
+def batch_to_device(batch, device, non_blocking=False):
+    if isinstance(batch, torch.Tensor):
+        return batch.to(device, non_blocking=non_blocking)
+    elif isinstance(batch, abc.Mapping):
+        if batch.get('cpu_only', False):
+            return batch
+        return {key: batch_to_device(batch[key], device, non_blocking) for key in batch}
+    elif isinstance(batch, abc.Sequence) and not isinstance(batch, str):
+        return [batch_to_device(b, device, non_blocking) for b in batch]
+    return batch
+
+
+def record_stream(batch, stream):
+    if isinstance(batch, torch.Tensor):
+        if batch.is_cuda:
+            batch.record_stream(stream)
+    elif isinstance(batch, abc.Mapping):
+        for key in batch:
+            record_stream(batch[key], stream)
+    elif isinstance(batch, abc.Sequence) and not isinstance(batch, str):
+        for b in batch:
+            record_stream(b, stream)
+
+
+class PrefetchLoader(object):
+    # copies the next `num_prefetch` batches to `device` on a side stream,
+    # batches come pinned from the DataLoader; without cuda batches are
+    # moved synchronously (a no-op on cpu)
+
+    def __init__(self, data_loader, device='cuda', num_prefetch=2):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.use_stream = self.device.type == 'cuda' and torch.cuda.is_available()
+
+    def __getattr__(self, name):
+        return getattr(self.data_loader, name)
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        if not self.use_stream:
+            for batch in self.data_loader:
+                yield batch_to_device(batch, self.device)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        queue = deque()
+        batches = iter(self.data_loader)
+
+        def preload():
+            batch = next(batches, None)
+            if batch is not None:
+                with torch.cuda.stream(stream):
+                    queue.append(batch_to_device(batch, self.device, non_blocking=True))
+
+        for i in range(self.num_prefetch):
+            preload()
+
+        while queue:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = queue.popleft()
+            record_stream(batch, current_stream)
+            preload()
+            yield batch
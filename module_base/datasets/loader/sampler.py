@@ -0,0 +1,104 @@
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import Sampler
+
+
+def get_dist_info():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def split_for_rank(items, num_replicas, rank, pad):
+    # with `pad` every rank gets the same count, the head is repeated to fill up
+    if pad:
+        total_size = int(np.ceil(len(items) / num_replicas)) * num_replicas
+        items = [items[i % len(items)] for i in range(total_size)] if items else []
+    return items[rank::num_replicas]
+
+
+class DistributedSampler(Sampler):
+
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, pad=True, seed=0):
+        if num_replicas is None or rank is None:
+            rank, num_replicas = get_dist_info()
+        self.num_samples = len(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.pad = pad
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            inds = np.random.RandomState(self.seed + self.epoch).permutation(self.num_samples)
+        else:
+            inds = np.arange(self.num_samples)
+        return iter(split_for_rank(inds.tolist(), self.num_replicas, self.rank, self.pad))
+
+    def __len__(self):
+        if self.pad:
+            return int(np.ceil(self.num_samples / self.num_replicas))
+        return len(range(self.rank, self.num_samples, self.num_replicas))
+
+
+class BucketBatchSampler(Sampler):
+    # batches only hold images whose shape rounds up to the same multiple of
+    # `size_divisor`, shuffled within and across buckets with `seed + epoch`;
+    # every rank builds the same batches and keeps its own share of them. The
+    # epoch only moves with `set_epoch`, iter() may run more than once per epoch
+
+    def __init__(self, dataset, batch_size, size_divisor=32, shuffle=True, drop_last=False, seed=0,
+                 num_replicas=1, rank=0, pad=True):
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pad = pad
+        self.batch_size = batch_size
+        self.size_divisor = size_divisor
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+        keys = np.ceil(dataset.get_img_shapes() / size_divisor).astype(np.int64)
+        self.bucket_ids = np.unique(keys, axis=0, return_inverse=True)[1].reshape(-1)
+        self.bucket_sizes = np.bincount(self.bucket_ids)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def get_batches(self):
+        rng = np.random.RandomState(self.seed + self.epoch)
+
+        batches = []
+        for bucket_id in range(len(self.bucket_sizes)):
+            inds = np.flatnonzero(self.bucket_ids == bucket_id)
+            if self.shuffle:
+                rng.shuffle(inds)
+            for i in range(0, len(inds), self.batch_size):
+                batch = inds[i:i + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append(batch.tolist())
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self.get_batches()
+        return iter(split_for_rank(batches, self.num_replicas, self.rank, self.pad))
+
+    def __len__(self):
+        if self.drop_last:
+            num_batches = int((self.bucket_sizes // self.batch_size).sum())
+        else:
+            num_batches = int(np.ceil(self.bucket_sizes / self.batch_size).sum())
+
+        if self.pad:
+            return int(np.ceil(num_batches / self.num_replicas))
+        return len(range(self.rank, num_batches, self.num_replicas))
@@ -1,11 +1,15 @@
-from .compose import Compose
+from .batch_transforms import BatchRescale, BatchNormalizeCustomize, BatchNormalizeInstance, BatchMotionBlur
+from .caching import SliceCache
+from .compose import Compose, BatchCompose
 from .formating import to_tensor, ToTensor, SliceToTensor, ImageToTensor, Collect
-from .loading import LoadDicomFromFile, LoadAnnotations
+from .loading import LoadDicomFromFile, LoadDicomCropFromFile, LoadAnnotations
+from .masks import LazyMasks
 from .transforms import NormalizeCustomize, NormalizeInstance, RandomCrop, Pad
 from .transforms import TargetFromBoxes, TargetFromRepair, TargetFromMotion
 
-__all__ = ['Compose',
+__all__ = ['BatchRescale', 'BatchNormalizeCustomize', 'BatchNormalizeInstance', 'BatchMotionBlur',
+           'SliceCache', 'LazyMasks', 'Compose', 'BatchCompose',
            'to_tensor', 'ToTensor', 'SliceToTensor', 'ImageToTensor', 'Collect',
-           'LoadDicomFromFile', 'LoadAnnotations',
+           'LoadDicomFromFile', 'LoadDicomCropFromFile', 'LoadAnnotations',
            'NormalizeCustomize', 'NormalizeInstance', 'RandomCrop', 'Pad',
            'TargetFromBoxes', 'TargetFromRepair', 'TargetFromMotion']
@@ -0,0 +1,143 @@
+import random
+import torch
+import numpy as np
+import torch.nn.functional as F
+from ..registry import BATCH_PIPELINES
+from .transforms import MotionKernelBank
+
+'''
+Batch transforms run on the collated batch in the main process:
+batch: dict(input=Tensor(N, ...), target=Tensor(N, ...), data_meta=dict(key=[...]))
+'''
+
+
+def _as_4d(data):
+    if data.dim() == 3:
+        return data.unsqueeze(1)
+    return data
+
+
+def _sample_shape(data):
+    return (-1,) + (1,) * (data.dim() - 1)
+
+
+def batch_minmax(data):
+    flat = data.reshape(data.size(0), -1)
+    if hasattr(torch, 'aminmax'):
+        return torch.aminmax(flat, dim=1)
+    return flat.min(1)[0], flat.max(1)[0]
+
+
+def batch_normalize_(data, mean, std):
+    # in place on the collated batch, which no one else references
+    if not data.is_floating_point():
+        data = data.float()
+    shape = _sample_shape(data)
+    return data.sub_(mean.view(shape)).div_(std.view(shape))
+
+
+@BATCH_PIPELINES.register_module
+class BatchRescale(object):
+
+    def __init__(self, keys=('input',)):
+        self.keys = keys
+
+    def __call__(self, batch):
+        rescale = batch['data_meta'].get('rescale')
+        for key in self.keys:
+            data = batch[key].float()
+            if rescale is not None:
+                shape = _sample_shape(data)
+                slope = torch.tensor([r['slope'] for r in rescale], device=data.device).view(shape)
+                intercept = torch.tensor([r['intercept'] for r in rescale], device=data.device).view(shape)
+                data = torch.addcmul(intercept, data, slope)
+            batch[key] = data
+        return batch
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(keys={})'.format(self.keys)
+
+
+@BATCH_PIPELINES.register_module
+class BatchNormalizeCustomize(object):
+
+    def __init__(self, eps=0.):
+        self.eps = eps
+
+    def _normalize(self, data):
+        a, b = batch_minmax(data)
+        mean, std = (a + b) / 2, (b - a) / 2
+        return batch_normalize_(data, mean, std + self.eps), mean, std
+
+    def __call__(self, batch):
+        batch['input'], mean, std = self._normalize(batch['input'])
+        batch['data_meta']['norm_cfg'] = [dict(mean=m, std=s) for m, s in zip(mean.tolist(), std.tolist())]
+
+        if 'target' in batch:
+            batch['target'], mean, std = self._normalize(batch['target'])
+            batch['data_meta']['target_norm_cfg'] = [dict(mean=m, std=s) for m, s in zip(mean.tolist(), std.tolist())]
+
+        return batch
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+@BATCH_PIPELINES.register_module
+class BatchNormalizeInstance(BatchNormalizeCustomize):
+
+    def _normalize(self, data):
+        if not data.is_floating_point():
+            data = data.float()
+        std, mean = torch.std_mean(data.reshape(data.size(0), -1), dim=1, unbiased=False)
+        return batch_normalize_(data, mean, std + self.eps), mean, std
+
+
+@BATCH_PIPELINES.register_module
+class BatchMotionBlur(object):
+    # batched `TargetFromMotion`: one grouped conv with a kernel per sample,
+    # reflect padding matches the BORDER_REFLECT_101 default of cv.filter2D
+
+    def __init__(self, invariant_prob=0.1, degree=(10, 20)):
+        self.invariant_prob = invariant_prob
+        self.degree = degree
+        self.kernels = MotionKernelBank(degree)
+
+    def __call__(self, batch):
+        input_data = batch['input']
+        target_data = input_data.clone()
+
+        inds = [i for i in range(input_data.size(0)) if random.random() >= self.invariant_prob]
+        if inds:
+            angles = [np.random.randint(0, 360) for _ in inds]
+            degrees = [np.random.randint(*self.degree) for _ in inds]
+
+            # embed every kernel in a k x k window with its anchor on the center
+            k = max(degrees)
+            weight = np.zeros((len(inds), 1, k, k), dtype=np.float32)
+            for j, (angle, degree) in enumerate(zip(angles, degrees)):
+                o = k // 2 - degree // 2
+                weight[j, 0, o:o + degree, o:o + degree] = self.kernels.get(angle, degree)[0]
+
+            x = _as_4d(input_data[inds])
+            n, c, h, w = x.shape
+            weight = torch.from_numpy(weight).to(x.device, x.dtype).repeat_interleave(c, 0)
+            x = F.pad(x.reshape(1, n * c, h, w), (k // 2, k - 1 - k // 2, k // 2, k - 1 - k // 2), mode='reflect')
+            x = F.conv2d(x, weight, groups=n * c).view(n, -1)
+
+            # cv.normalize(NORM_MINMAX) onto the range of the target
+            lo, hi = batch_minmax(x)
+            t_lo, t_hi = batch_minmax(target_data[inds])
+            scale = torch.where(hi - lo > 0, (t_hi - t_lo) / (hi - lo), torch.zeros_like(lo))
+            x = (x - lo[:, None]) * scale[:, None] + t_lo[:, None]
+
+            input_data = input_data.clone()
+            input_data[inds] = x.view_as(input_data[inds])
+
+        batch['input'] = input_data
+        batch['target'] = target_data
+
+        return batch
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(invariant_prob={}, degree={})'.format(self.invariant_prob, self.degree)
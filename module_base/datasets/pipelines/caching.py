@@ -0,0 +1,60 @@
+import os
+import json
+import hashlib
+import numpy as np
+import os.path as osp
+from utils import DiskLRU
+
+'''
+Decoded slices are stored as `<sha1>.npy`, keyed by (abspath, mtime, size, tag),
+in a `DiskLRU` directory, so concurrent DataLoader workers never observe a
+partial entry. Entries are loaded with `np.load(mmap_mode=...)`; the default
+'c' (copy-on-write) keeps in-place transforms legal without touching the file
+on disk. Optional per-slice meta
+(e.g. rescale slope/intercept) is kept in `<sha1>.json`, written first.
+'''
+
+
+class SliceCache(object):
+
+    def __init__(self, cache_dir, max_bytes=32 << 30, mmap_mode='c'):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.mmap_mode = mmap_mode
+        self.lru = DiskLRU(cache_dir, max_bytes, '.npy', companions=('.json',))
+
+    def _path(self, filename, tag):
+        st = os.stat(filename)
+        key = '{}|{}|{}|{}'.format(osp.abspath(filename), st.st_mtime_ns, st.st_size, tag)
+        return self.lru.path(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, filename, tag=''):
+        path = self._path(filename, tag)
+        try:
+            data = np.load(path, mmap_mode=self.mmap_mode)
+        except (OSError, ValueError):
+            return None, None
+        self.lru.touch(path)
+
+        meta = None
+        try:
+            with open(path[:-4] + '.json', 'r') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        return data, meta
+
+    def put(self, filename, data, tag='', meta=None):
+        path = self._path(filename, tag)
+        if meta is not None:
+            if not self.lru.write(path[:-4] + '.json', lambda f: f.write(json.dumps(meta).encode('utf-8'))):
+                return
+        if not self.lru.write(path, lambda f: np.save(f, np.ascontiguousarray(data))):
+            return
+        self.lru.added(data.nbytes)
+
+    def evict(self):
+        self.lru.evict()
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(cache_dir={}, max_bytes={})'.format(self.cache_dir, self.max_bytes)
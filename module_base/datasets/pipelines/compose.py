@@ -1,32 +1,136 @@
+import time
+import torch
+import logging
+import numpy as np
+from torch.utils.data import get_worker_info
 from utils import build_from_cfg
-from ..registry import PIPELINES
+from ..registry import PIPELINES, BATCH_PIPELINES
+
+
+def snapshot(data):
+    # containers are copied, arrays are shared: a retryable transform must
+    # not write into the arrays of its input
+    if isinstance(data, dict):
+        return {k: snapshot(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [snapshot(v) for v in data]
+    return data
+
+
+def nbytes(data):
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, torch.Tensor):
+        return data.element_size() * data.nelement()
+    if isinstance(data, dict):
+        return sum(nbytes(v) for v in data.values())
+    if isinstance(data, (list, tuple)):
+        return sum(nbytes(v) for v in data)
+    return 0
 
 
 @PIPELINES.register_module
 class Compose(object):
 
-    def __init__(self, transforms):
+    registry = PIPELINES
+    counter_names = ('calls', 'retries', 'fallbacks')
+
+    def __init__(self, transforms, profile_interval=0, max_workers=64):
         self.transforms = []
+        self.retries = []
         for transform in transforms:
             if isinstance(transform, dict):
-                transform = build_from_cfg(transform, PIPELINES)
+                transform = transform.copy()
+                self.retries.append(transform.pop('retries', 0))
+                transform = build_from_cfg(transform, self.registry)
                 self.transforms.append(transform)
             elif callable(transform):
+                self.retries.append(0)
                 self.transforms.append(transform)
             else:
                 raise TypeError('transform must be callable or a dict')
 
+        # shared with the DataLoader workers, one row per process (the main
+        # process and up to `max_workers` workers) so that no two processes
+        # update the same slot; rows are summed when read
+        num_rows = max_workers + 1
+        self.counters = torch.zeros(num_rows, len(self.counter_names), dtype=torch.int64).share_memory_()
+
+        # per transform: calls, seconds, output bytes
+        self.profile_interval = profile_interval
+        if profile_interval:
+            self.timings = torch.zeros(num_rows, len(self.transforms), 3, dtype=torch.float64).share_memory_()
+
+    def _row(self):
+        info = get_worker_info()
+        return 0 if info is None else 1 + info.id % (len(self.counters) - 1)
+
+    def _apply(self, t, retries, data, counters):
+        if retries:
+            state = snapshot(data)
+
+        data_ = t(data)
+        for i in range(retries):
+            if data_ is not None:
+                break
+            counters[1] += 1
+            data_ = t(snapshot(state))
+        return data_
+
     def __call__(self, data):
-        for t in self.transforms:
-            data = t(data)
+        if self.profile_interval:
+            return self._profile_call(data)
+
+        counters = self.counters[self._row()]
+        counters[0] += 1
+        for t, retries in zip(self.transforms, self.retries):
+            data = self._apply(t, retries, data, counters)
             if data is None:
+                counters[2] += 1
                 return None
         return data
 
+    def _profile_call(self, data):
+        row = self._row()
+        counters, timings = self.counters[row], self.timings[row]
+        counters[0] += 1
+        for i, (t, retries) in enumerate(zip(self.transforms, self.retries)):
+            start = time.perf_counter()
+            data = self._apply(t, retries, data, counters)
+            timings[i, 0] += 1
+            timings[i, 1] += time.perf_counter() - start
+            timings[i, 2] += nbytes(data)
+            if data is None:
+                counters[2] += 1
+                break
+
+        # every worker logs after each `profile_interval` of its own samples
+        if int(counters[0]) % self.profile_interval == 0:
+            logging.getLogger().info(self.profile_summary())
+        return data
+
+    def stats(self):
+        return dict(zip(self.counter_names, self.counters.sum(0).tolist()))
+
+    def profile_summary(self):
+        timings = self.timings.sum(0).tolist()
+        total = sum(v[1] for v in timings) or 1.
+        message = ['{}:{:.3f}ms/{:.1f}%/{:.2f}MB'.format(
+            t.__class__.__name__, 1e3 * v[1] / max(v[0], 1), 100 * v[1] / total, v[2] / max(v[0], 1) / 2 ** 20)
+            for t, v in zip(self.transforms, timings)]
+        return '{}/{}'.format(int(self.counters[:, 0].sum()), ','.join(message))
+
     def __repr__(self):
         format_string = self.__class__.__name__ + '('
-        for t in self.transforms:
+        for t, retries in zip(self.transforms, self.retries):
             format_string += '\n'
             format_string += '    {}'.format(t)
+            if retries:
+                format_string += ' x{}'.format(retries + 1)
         format_string += '\n)'
         return format_string
+
+
+class BatchCompose(Compose):
+
+    registry = BATCH_PIPELINES
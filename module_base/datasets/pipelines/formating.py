@@ -1,6 +1,7 @@
 import torch
 import numpy as np
 from ..registry import PIPELINES
+from .masks import LazyMasks
 
 
 def to_tensor(data):
@@ -66,9 +67,10 @@ class ImageToTensor(object):
 @PIPELINES.register_module
 class Collect(object):
 
-    def __init__(self, keys, meta_keys=('filename', 'ori_shape', 'norm_cfg')):
+    def __init__(self, keys, meta_keys=('filename', 'ori_shape', 'norm_cfg'), bitpack_masks=False):
         self.keys = keys
         self.meta_keys = meta_keys
+        self.bitpack_masks = bitpack_masks
 
     def __call__(self, results):
         data = {}
@@ -79,7 +81,10 @@ class Collect(object):
         data['data_meta'] = data_meta
         for key in self.keys:
             data[key] = results[key]
-        return results
+            if isinstance(data[key], LazyMasks):
+                data[key] = data[key].to_ndarray(self.bitpack_masks)
+        return data
 
     def __repr__(self):
-        return self.__class__.__name__ + '(keys={}, meta_keys={})'.format(self.keys, self.meta_keys)
+        return self.__class__.__name__ + '(keys={}, meta_keys={}, bitpack_masks={})'.format(
+            self.keys, self.meta_keys, self.bitpack_masks)
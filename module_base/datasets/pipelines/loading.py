@@ -1,81 +1,316 @@
+import os
+import struct
+import numpy as np
 import os.path as osp
 import SimpleITK as sitk
 import pycocotools.mask as maskUtils
 from ..registry import PIPELINES
+from .caching import SliceCache
+from .masks import LazyMasks, to_rle
+from .transforms import CropCounter, crop_boxes, crop_masks, random_crop_window
 
 '''
 pip install SimpleITK
 
 sitk image: (width, height, depth)
 sitk ndarray: (depth, height, width)
+
+0028|0002 - Samples per Pixel
+0028|0008 - Number of Frames
+0028|0010 - Rows
+0028|0011 - Columns
+0028|0100 - Bits Allocated
+0028|0101 - Bits Stored
+0028|0103 - Pixel Representation(0: unsigned, 1: signed)
+0028|1052 - Rescale Intercept
+0028|1053 - Rescale Slope
+
+GDCM always decodes the whole slice, even with `SetExtractIndex`/`SetExtractSize`.
+`map_pixel_data` maps PixelData of uncompressed files instead, so a crop only pages
+in its own rows; compressed slices are decoded in full unless they come from
+`cache_cfg` or `ShardDataset`.
 '''
 
+# implicit / explicit VR little endian
+RAW_SYNTAXES = ('1.2.840.10008.1.2', '1.2.840.10008.1.2.1')
+PIXEL_DATA_TAG = b'\xe0\x7f\x10\x00'
+_LONG_VRS = (b'OB', b'OD', b'OF', b'OL', b'OW', b'SQ', b'UC', b'UN', b'UR', b'UT')
+
+
+def _get_tag(itk_obj, key, default):
+    if itk_obj.HasMetaDataKey(key):
+        return itk_obj.GetMetaData(key).strip()
+    return default
+
+
+def _rescale(itk_obj):
+    return dict(slope=float(_get_tag(itk_obj, '0028|1053', 1.)),
+                intercept=float(_get_tag(itk_obj, '0028|1052', 0.)))
+
+
+def _stored_dtype(itk_obj):
+    signed = _get_tag(itk_obj, '0028|0103', '0') == '1'
+    bits = int(_get_tag(itk_obj, '0028|0101', 16))
+    return np.int16 if signed or bits < 16 else np.uint16
+
+
+def to_stored_pixels(data, itk_obj):
+    # GDCM applies RescaleSlope/Intercept on read and widens the pixel type,
+    # undo it so the slice moves through the pipeline as 16-bit stored values
+    rescale = _rescale(itk_obj)
+    if rescale['slope'] != 1. or rescale['intercept'] != 0.:
+        data = np.rint((data - rescale['intercept']) / rescale['slope'])
+    return data.astype(_stored_dtype(itk_obj), copy=False), rescale
+
+
+def transfer_syntax(filename):
+    # the file meta group (0002) is always explicit VR little endian
+    with open(filename, 'rb') as f:
+        head = f.read(4096)
+    if head[128:132] != b'DICM':
+        return None
+
+    pos = 132
+    while pos + 8 <= len(head):
+        group, element = struct.unpack_from('<HH', head, pos)
+        if group != 2:
+            break
+        if head[pos + 4:pos + 6] in _LONG_VRS:
+            length = struct.unpack_from('<I', head, pos + 8)[0]
+            pos += 12
+        else:
+            length = struct.unpack_from('<H', head, pos + 6)[0]
+            pos += 8
+        if element == 0x0010:
+            return head[pos:pos + length].rstrip(b'\0 ').decode('ascii')
+        pos += length
+    return None
+
+
+def map_pixel_data(filename, itk_obj):
+    # stored pixels of an uncompressed single-frame 16-bit slice, or None;
+    # PixelData has to be the last element, its header is checked in front of
+    # the last `nbytes` of the file
+    if _get_tag(itk_obj, '0028|0002', '1') != '1' or _get_tag(itk_obj, '0028|0100', '16') != '16' \
+            or int(_get_tag(itk_obj, '0028|0008', '') or 1) != 1:
+        return None
+    signed = _get_tag(itk_obj, '0028|0103', '0') == '1'
+    bits = int(_get_tag(itk_obj, '0028|0101', 16))
+    if signed and bits < 16:
+        return None  # GDCM sign-extends from the stored bits
+    if transfer_syntax(filename) not in RAW_SYNTAXES:
+        return None
+
+    rows, cols = int(_get_tag(itk_obj, '0028|0010', 0)), int(_get_tag(itk_obj, '0028|0011', 0))
+    nbytes = rows * cols * 2
+    offset = os.path.getsize(filename) - nbytes
+    if nbytes == 0 or offset < 12:
+        return None
+    with open(filename, 'rb') as f:
+        f.seek(offset - 12)
+        header = f.read(12)
+    length = struct.pack('<I', nbytes)
+    implicit = header[4:] == PIXEL_DATA_TAG + length
+    explicit = header[:4] == PIXEL_DATA_TAG and header[4:6] in (b'OW', b'OB') and header[6:] == b'\0\0' + length
+    if not (implicit or explicit):
+        return None
+
+    dtype = np.dtype('<i2' if signed else '<u2')
+    return np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=(rows, cols))
+
+
+def crop_stored_pixels(pixels, patch, itk_obj):
+    data = np.array(pixels[patch[1]:patch[3], patch[0]:patch[2]])
+    bits = int(_get_tag(itk_obj, '0028|0101', 16))
+    if bits < 16:
+        # the unused high bits may carry overlays, GDCM masks them too
+        data &= (1 << bits) - 1
+    return data.astype(_stored_dtype(itk_obj), copy=False), _rescale(itk_obj)
+
+
+def apply_rescale(data, rescale):
+    data = data.astype(np.float32)
+    if rescale['slope'] != 1.:
+        data *= rescale['slope']
+    if rescale['intercept'] != 0.:
+        data += rescale['intercept']
+    return data
+
+
+def read_dicom(filename, to_float32=True):
+    if to_float32:
+        itk_img = sitk.ReadImage(filename, sitk.sitkFloat32)
+        return sitk.GetArrayFromImage(itk_img)[0], None  # (height, width)
+
+    itk_img = sitk.ReadImage(filename)
+    return to_stored_pixels(sitk.GetArrayFromImage(itk_img)[0], itk_img)
+
 
 @PIPELINES.register_module
 class LoadDicomFromFile(object):
 
-    def __init__(self):
-        pass
+    def __init__(self, to_float32=True, cache_cfg=None):
+        self.to_float32 = to_float32
+        self.cache_cfg = cache_cfg
+        self.cache = SliceCache(**cache_cfg) if cache_cfg else None
+        self.cache_tag = '' if to_float32 else 'stored'
 
-    def __call__(self, results):
+    def _get_filename(self, results):
         if results['data_root'] is not None:
-            filename = osp.join(results['data_root'], results['img_info']['filename'])
+            return osp.join(results['data_root'], results['img_info']['filename'])
+        return results['img_info']['filename']
+
+    def _load(self, results, filename):
+        data = results.pop('img_data', None)  # served by ShardDataset
+        rescale = results.pop('rescale', None)
+
+        if data is None and self.cache is not None:
+            data, rescale = self.cache.get(filename, self.cache_tag)
+
+        if data is None:
+            data, rescale = read_dicom(filename, self.to_float32)
+            if self.cache is not None:
+                self.cache.put(filename, data, self.cache_tag, rescale)
+
+        return data, rescale
+
+    def _convert(self, data, rescale):
+        if self.to_float32:
+            if rescale is not None:
+                data = apply_rescale(data, rescale)
+        elif rescale is None:
+            # float is deferred to `BatchRescale` on the collated batch
+            rescale = dict(slope=1., intercept=0.)
+
+        # read-only shard views are copied once, transforms may write in place
+        if not data.flags.writeable:
+            data = np.array(data)
+        return data, None if self.to_float32 else rescale
+
+    def __call__(self, results):
+        filename = self._get_filename(results)
+        input_data, rescale = self._convert(*self._load(results, filename))
+
+        results['filename'] = filename
+        results['input'] = input_data
+        results['ori_shape'] = input_data.shape
+        if rescale is not None:
+            results['rescale'] = rescale
+
+        return results
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(to_float32={}, cache_cfg={})'.format(self.to_float32, self.cache_cfg)
+
+
+@PIPELINES.register_module
+class LoadDicomCropFromFile(LoadDicomFromFile):
+    # replaces `LoadDicomFromFile` + `RandomCrop`: the window is chosen from the
+    # header (or from an already mapped slice); only its rows are read when the
+    # file is uncompressed, see `map_pixel_data`
+
+    def __init__(self, crop_size, to_clear=True, to_float32=True, cache_cfg=None):
+        super(LoadDicomCropFromFile, self).__init__(to_float32, cache_cfg)
+        self.crop_size = crop_size
+        self.to_clear = to_clear
+        self.counter = CropCounter(self.__class__.__name__)
+
+    def __call__(self, results):
+        filename = self._get_filename(results)
+
+        reader = None
+        if 'img_data' in results or self.cache is not None:
+            full_data, rescale = self._load(results, filename)
+            full_shape = full_data.shape
         else:
-            filename = results['img_info']['filename']
+            reader = sitk.ImageFileReader()
+            reader.SetFileName(filename)
+            reader.ReadImageInformation()
+            size = reader.GetSize()
+            full_shape = (size[1], size[0])
 
-        itk_img = sitk.ReadImage(filename, sitk.sitkFloat32)
-        input_data = sitk.GetArrayFromImage(itk_img)[0]  # (height, width)
+        assert 0 < self.crop_size <= min(full_shape)
+
+        boxes = results['ann_info']['boxes']
+        patch = random_crop_window(full_shape, self.crop_size, boxes, self.to_clear)
+        self.counter.update(patch)
+        if patch is None:
+            return None
+
+        pixels = map_pixel_data(filename, reader) if reader is not None else None
+        if reader is None:
+            input_data = np.array(full_data[patch[1]:patch[3], patch[0]:patch[2]])
+        elif pixels is not None:
+            input_data, rescale = crop_stored_pixels(pixels, patch, reader)
+        else:
+            # compressed: GDCM decodes the whole slice and returns the window
+            if self.to_float32:
+                reader.SetOutputPixelType(sitk.sitkFloat32)
+            reader.SetExtractIndex([int(patch[0]), int(patch[1])] + [0] * (len(size) - 2))
+            reader.SetExtractSize([self.crop_size, self.crop_size] + [1] * (len(size) - 2))
+            input_data = sitk.GetArrayFromImage(reader.Execute())
+            input_data = input_data.reshape(self.crop_size, self.crop_size)
+
+            rescale = None
+            if not self.to_float32:
+                input_data, rescale = to_stored_pixels(input_data, reader)
+
+        input_data, rescale = self._convert(input_data, rescale)
+
+        results['ann_info'] = dict(results['ann_info'], boxes=crop_boxes(boxes, patch))
+        results['crop_window'] = patch
+        results['full_shape'] = full_shape
 
         results['filename'] = filename
         results['input'] = input_data
         results['ori_shape'] = input_data.shape
+        if rescale is not None:
+            results['rescale'] = rescale
 
         return results
 
     def __repr__(self):
-        return self.__class__.__name__ + '()'
+        return self.__class__.__name__ + '(crop_size={}, to_clear={}, to_float32={}, cache_cfg={})'.format(
+            self.crop_size, self.to_clear, self.to_float32, self.cache_cfg)
 
 
 @PIPELINES.register_module
 class LoadAnnotations(object):
 
-    def __init__(self, with_bbox=False, with_mask=False, poly2mask=True):
+    def __init__(self, with_bbox=False, with_mask=False, poly2mask=True, lazy_mask=False):
         self.with_bbox = with_bbox
         self.with_mask = with_mask
         self.poly2mask = poly2mask
+        self.lazy_mask = lazy_mask
 
     def _load_boxes(self, results):
         results['gt_boxes'] = results['ann_info']['boxes']
         return results
 
     def _poly2mask(self, mask_ann, img_h, img_w):
-        if isinstance(mask_ann, list):
-            # polygon -- a single object might consist of multiple parts
-            # we merge all parts into one mask rle code
-            rles = maskUtils.frPyObjects(mask_ann, img_h, img_w)
-            rle = maskUtils.merge(rles)
-        elif isinstance(mask_ann['counts'], list):
-            # uncompressed RLE
-            rle = maskUtils.frPyObjects(mask_ann, img_h, img_w)
-        else:
-            # rle
-            rle = mask_ann
-        mask = maskUtils.decode(rle)
+        mask = maskUtils.decode(to_rle(mask_ann, img_h, img_w))
         return mask
 
     def _load_masks(self, results):
-        h, w = results['ori_shape']
+        h, w = results.get('full_shape', results['ori_shape'])
         gt_masks = results['ann_info']['masks']
 
-        if self.poly2mask:
+        if self.lazy_mask:
+            # stays RLE, rasterized by `Collect` inside the final window only
+            gt_masks = LazyMasks([to_rle(mask, h, w) for mask in gt_masks], h, w)
+            if 'crop_window' in results:
+                gt_masks = gt_masks.crop(results['crop_window'])
+        elif self.poly2mask:
             gt_masks = [self._poly2mask(mask, h, w) for mask in gt_masks]
+            if 'crop_window' in results:
+                gt_masks = crop_masks(gt_masks, results['crop_window'])
         results['gt_masks'] = gt_masks
 
         return results
 
     def __call__(self, results):
         if self.with_bbox:
-            results = self._load_bboxes(results)
+            results = self._load_boxes(results)
 
         if self.with_mask:
             results = self._load_masks(results)
@@ -83,4 +318,5 @@ class LoadAnnotations(object):
         return results
 
     def __repr__(self):
-        return self.__class__.__name__ + '(with_bbox={}, with_mask={})'.format(self.with_bbox, self.with_mask)
+        return self.__class__.__name__ + '(with_bbox={}, with_mask={}, lazy_mask={})'.format(
+            self.with_bbox, self.with_mask, self.lazy_mask)
@@ -0,0 +1,123 @@
+import numpy as np
+import pycocotools.mask as maskUtils
+
+'''
+Masks kept as compressed COCO RLE of the full slice plus a window
+(x1, y1, x2, y2) in full-slice coordinates. Crop and pad only move the
+window, nothing is rasterized until `to_ndarray` (see `Collect`), and then
+only the columns under the window are expanded.
+
+COCO RLE is column-major: counts alternate runs of 0 and 1 starting with 0.
+'''
+
+
+def to_rle(mask_ann, img_h, img_w):
+    if isinstance(mask_ann, list):
+        # polygon -- a single object might consist of multiple parts
+        return maskUtils.merge(maskUtils.frPyObjects(mask_ann, img_h, img_w))
+    elif isinstance(mask_ann['counts'], list):
+        # uncompressed RLE
+        return maskUtils.frPyObjects(mask_ann, img_h, img_w)
+    return mask_ann
+
+
+def rle_string_to_counts(s):
+    # vectorized rleFrString from the coco maskApi.c: 5 bits per char,
+    # 0x20 continues a number, 0x10 of the last char is the sign, and
+    # from the 4th count on each value is a delta to the count two back
+    if isinstance(s, str):
+        s = s.encode('ascii')
+    c = np.frombuffer(s, dtype=np.uint8).astype(np.int64) - 48
+    if not len(c):
+        return np.zeros(0, dtype=np.int64)
+
+    last = (c & 0x20) == 0
+    ends = np.flatnonzero(last)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    k = np.arange(len(c)) - np.repeat(starts, ends - starts + 1)
+    x = np.add.reduceat((c & 0x1f) << (5 * k), starts)
+
+    negative = (c[ends] & 0x10) != 0
+    x[negative] |= -1 << (5 * (k[ends[negative]] + 1))
+
+    counts = x.copy()
+    if len(x) > 3:
+        counts[3::2] = np.cumsum(x[3::2]) + x[1]
+        counts[4::2] = np.cumsum(x[4::2]) + x[2]
+    return counts
+
+
+def decode_window(counts, height, x1, y1, x2, y2):
+    counts = np.asarray(counts, dtype=np.int64)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    # runs of 1 clipped to the columns [x1, x2)
+    lo, hi = x1 * height, x2 * height
+    s = starts[1::2].clip(lo, hi) - lo
+    e = ends[1::2].clip(lo, hi) - lo
+    keep = e > s
+
+    diff = np.zeros(hi - lo + 1, dtype=np.int8)
+    np.add.at(diff, s[keep], 1)
+    np.add.at(diff, e[keep], -1)
+    cols = np.cumsum(diff[:-1], dtype=np.int8).reshape(x2 - x1, height)
+    return np.ascontiguousarray(cols[:, y1:y2].T).view(np.uint8)
+
+
+class LazyMasks(object):
+
+    def __init__(self, rles, height, width, window=None, clip=None, min_area=0):
+        self.rles = rles
+        self.height = height
+        self.width = width
+        # window: region returned by `to_ndarray`, clip: region whose pixels are
+        # still valid, both in slice coordinates; outside of clip is padding
+        self.window = (0, 0, width, height) if window is None else tuple(int(v) for v in window)
+        self.clip = (0, 0, width, height) if clip is None else tuple(int(v) for v in clip)
+        self.min_area = min_area
+
+    def __len__(self):
+        return len(self.rles)
+
+    @property
+    def shape(self):
+        x1, y1, x2, y2 = self.window
+        return (len(self.rles), y2 - y1, x2 - x1)
+
+    def crop(self, patch):
+        # same semantics as `crop_masks`: masks with less than 2 pixels are dropped
+        x1, y1 = self.window[:2]
+        window = (x1 + patch[0], y1 + patch[1], x1 + patch[2], y1 + patch[3])
+        clip = (max(self.clip[0], window[0]), max(self.clip[1], window[1]),
+                min(self.clip[2], window[2]), min(self.clip[3], window[3]))
+        return LazyMasks(self.rles, self.height, self.width, window, clip, min_area=2)
+
+    def pad(self, shape):
+        x1, y1 = self.window[:2]
+        window = (x1, y1, x1 + shape[1], y1 + shape[0])
+        return LazyMasks(self.rles, self.height, self.width, window, self.clip, self.min_area)
+
+    def to_ndarray(self, bitpack=False):
+        x1, y1, x2, y2 = self.window
+        cx1, cy1 = max(self.clip[0], x1), max(self.clip[1], y1)
+        cx2, cy2 = max(min(self.clip[2], x2), cx1), max(min(self.clip[3], y2), cy1)
+
+        masks = []
+        for rle in self.rles:
+            mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+            if cx2 > cx1 and cy2 > cy1:
+                counts = rle_string_to_counts(rle['counts'])
+                mask[cy1 - y1:cy2 - y1, cx1 - x1:cx2 - x1] = decode_window(counts, self.height, cx1, cy1, cx2, cy2)
+            if self.min_area and mask.sum() < self.min_area:
+                continue
+            masks.append(mask)
+
+        masks = np.stack(masks, axis=0) if masks else np.zeros((0, y2 - y1, x2 - x1), dtype=np.uint8)
+        if bitpack:
+            masks = np.packbits(masks, axis=-1)
+        return masks
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(num_masks={}, shape={}, window={})'.format(
+            len(self.rles), (self.height, self.width), self.window)
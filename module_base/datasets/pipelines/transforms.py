@@ -1,7 +1,10 @@
 import random
+import logging
 import cv2 as cv
 import numpy as np
+from collections import OrderedDict
 from ..registry import PIPELINES
+from .masks import LazyMasks
 
 '''
 sitk image: (width, height, depth)
@@ -19,6 +22,27 @@ def pad2d(data, shape, fill_value):
     return padded_data
 
 
+def minmax_stats(data):
+    # one pass for both min and max
+    a, b = cv.minMaxLoc(data)[:2]
+    return np.float32((a + b) / 2), np.float32((b - a) / 2)
+
+
+def instance_stats(data):
+    # one pass for both mean and std
+    mean, std = cv.meanStdDev(data)
+    return np.float32(mean.item()), np.float32(std.item())
+
+
+def normalize_(data, mean, std):
+    # in place, unless the slice is not a writable float32 buffer yet
+    if data.dtype != np.float32 or not data.flags.writeable:
+        data = data.astype(np.float32)
+    np.subtract(data, mean, out=data)
+    np.divide(data, std, out=data)
+    return data
+
+
 @PIPELINES.register_module
 class NormalizeCustomize(object):
 
@@ -26,23 +50,14 @@ class NormalizeCustomize(object):
         self.eps = eps
 
     def __call__(self, results):
-        input_data = results['input']
-        a, b = input_data.min(), input_data.max()
-
-        mean, std = (a + b) / 2, (b - a) / 2
-        input_data = (input_data - mean) / (std + self.eps)
-
-        results['input'] = input_data
+        mean, std = minmax_stats(results['input'])
+        results['input'] = normalize_(results['input'], mean, std + self.eps)
         results['norm_cfg'] = dict(mean=mean, std=std)
 
         if 'target' in results:
-            target_data = results['target']
-            a, b = target_data.min(), target_data.max()
-
-            mean, std = (a + b) / 2, (b - a) / 2
-            target_data = (target_data - mean) / (std + self.eps)
-
-            results['target'] = target_data
+            mean, std = minmax_stats(results['target'])
+            results['target'] = normalize_(results['target'], mean, std + self.eps)
+            results['target_norm_cfg'] = dict(mean=mean, std=std)
 
         return results
 
@@ -57,19 +72,14 @@ class NormalizeInstance(object):
         self.eps = eps
 
     def __call__(self, results):
-        input_data = results['input']
-        mean, std = input_data.mean(), input_data.std()
-        input_data = (input_data - mean) / (std + self.eps)
-
-        results['input'] = input_data
+        mean, std = instance_stats(results['input'])
+        results['input'] = normalize_(results['input'], mean, std + self.eps)
         results['norm_cfg'] = dict(mean=mean, std=std)
 
         if 'target' in results:
-            target_data = results['target']
-            mean, std = target_data.mean(), target_data.std()
-            target_data = (target_data - mean) / (std + self.eps)
-
-            results['target'] = target_data
+            mean, std = instance_stats(results['target'])
+            results['target'] = normalize_(results['target'], mean, std + self.eps)
+            results['target_norm_cfg'] = dict(mean=mean, std=std)
 
         return results
 
@@ -77,53 +87,128 @@ class NormalizeInstance(object):
         return self.__class__.__name__ + '()'
 
 
+def crop_boxes(boxes, patch):
+    boxes = boxes.copy()
+    boxes[:, 2:] = boxes[:, 2:].clip(max=patch[2:])
+    boxes[:, :2] = boxes[:, :2].clip(min=patch[:2])
+    boxes -= np.tile(patch[:2], 2)
+
+    valid_inds = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    return boxes[valid_inds, :]
+
+
+def crop_masks(masks, patch):
+    if isinstance(masks, LazyMasks):
+        return masks.crop(patch)
+    valid_masks = [mask[patch[1]:patch[3], patch[0]:patch[2]] for mask in masks]
+    return [mask for mask in valid_masks if mask.sum() > 1]
+
+
+def sample_clear_window(shape, crop_size, boxes):
+    ny, nx = shape[0] - crop_size + 1, shape[1] - crop_size + 1
+
+    # a window at (x, y) keeps a box (see crop_boxes) iff x1 - crop_size < x < x2
+    # and y1 - crop_size < y < y2, so every box blocks a rectangle of top-left positions
+    boxes = boxes[(boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])]
+    xs1 = (np.floor(boxes[:, 0] - crop_size) + 1).clip(0, nx).astype(np.int64)
+    xs2 = np.ceil(boxes[:, 2]).clip(0, nx).astype(np.int64)
+    ys1 = (np.floor(boxes[:, 1] - crop_size) + 1).clip(0, ny).astype(np.int64)
+    ys2 = np.ceil(boxes[:, 3]).clip(0, ny).astype(np.int64)
+
+    # occupancy integral image on the grid compressed to the rectangle edges
+    xs = np.unique(np.concatenate([[0, nx], xs1, xs2]))
+    ys = np.unique(np.concatenate([[0, ny], ys1, ys2]))
+    ix1, ix2 = np.searchsorted(xs, xs1), np.searchsorted(xs, xs2)
+    iy1, iy2 = np.searchsorted(ys, ys1), np.searchsorted(ys, ys2)
+
+    grid = np.zeros((len(ys), len(xs)), dtype=np.int32)
+    np.add.at(grid, (iy1, ix1), 1)
+    np.add.at(grid, (iy1, ix2), -1)
+    np.add.at(grid, (iy2, ix1), -1)
+    np.add.at(grid, (iy2, ix2), 1)
+    occupied = grid.cumsum(0).cumsum(1)[:-1, :-1] > 0
+
+    # pick a free cell by its number of positions, then a position inside it
+    area = np.diff(ys)[:, None] * np.diff(xs)[None, :]
+    area[occupied] = 0
+    cum_area = area.ravel().cumsum()
+    if cum_area[-1] == 0:
+        return None
+
+    k = np.searchsorted(cum_area, np.random.randint(cum_area[-1]), side='right')
+    iy, ix = divmod(k, len(xs) - 1)
+    y = ys[iy] + np.random.randint(ys[iy + 1] - ys[iy])
+    x = xs[ix] + np.random.randint(xs[ix + 1] - xs[ix])
+    return np.array([x, y, x + crop_size, y + crop_size])
+
+
+def random_crop_window(shape, crop_size, boxes=None, to_clear=True):
+    if to_clear and boxes is not None and len(boxes):
+        return sample_clear_window(shape, crop_size, boxes)
+
+    y = np.random.randint(0, shape[0] - crop_size + 1)
+    x = np.random.randint(0, shape[1] - crop_size + 1)
+    return np.array([x, y, x + crop_size, y + crop_size])
+
+
+class CropCounter(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.num_crops = 0
+        self.num_infeasible = 0
+
+    def update(self, patch):
+        self.num_crops += 1
+        if patch is None:
+            self.num_infeasible += 1
+            # report at 1, 2, 4, 8, ... infeasible samples
+            if self.num_infeasible & (self.num_infeasible - 1) == 0:
+                logging.getLogger().warning('{}: no clear window in {}/{} samples'.format(
+                    self.name, self.num_infeasible, self.num_crops))
+
+
 @PIPELINES.register_module
 class RandomCrop(object):
 
     def __init__(self, crop_size, to_clear=True):
         self.crop_size = crop_size
         self.to_clear = to_clear
+        self.counter = CropCounter(self.__class__.__name__)
 
     def __call__(self, results):
         input_data = results['input']
         assert 0 < self.crop_size <= min(input_data.shape)
 
-        for i in range(30):
-            y = np.random.randint(0, input_data.shape[0] - self.crop_size + 1)
-            x = np.random.randint(0, input_data.shape[1] - self.crop_size + 1)
-            patch = np.array([x, y, x + self.crop_size, y + self.crop_size])
-
-            # adjust boxes
-            if 'gt_boxes' in results:
-                boxes = results['gt_boxes']
-                boxes[:, 2:] = boxes[:, 2:].clip(max=patch[2:])
-                boxes[:, :2] = boxes[:, :2].clip(min=patch[:2])
-                boxes -= np.tile(patch[:2], 2)
+        patch = random_crop_window(input_data.shape, self.crop_size, results.get('gt_boxes'), self.to_clear)
+        self.counter.update(patch)
+        if patch is None:
+            return None
 
-                valid_inds = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
-                if self.to_clear and np.any(valid_inds):
-                    continue
+        # adjust boxes
+        if 'gt_boxes' in results:
+            results['gt_boxes'] = crop_boxes(results['gt_boxes'], patch)
 
-                results['gt_boxes'] = boxes[valid_inds, :]
+        # adjust masks
+        if 'gt_masks' in results:
+            results['gt_masks'] = crop_masks(results['gt_masks'], patch)
 
-            # adjust masks
-            if 'gt_masks' in results:
-                valid_masks = [mask[patch[1]:patch[3], patch[0]:patch[2]] for mask in results['gt_masks']]
-                valid_masks = [mask for mask in valid_masks if mask.sum() > 1]
-                results['gt_masks'] = valid_masks
+        # adjust target
+        if 'target' in results:
+            target_data = results['target'][patch[1]:patch[3], patch[0]:patch[2]]
+            results['target'] = target_data
 
-            # adjust target
-            if 'target' in results:
-                target_data = results['target'][patch[1]:patch[3], patch[0]:patch[2]]
-                results['target'] = target_data
+        input_data = input_data[patch[1]:patch[3], patch[0]:patch[2]]
 
-            input_data = input_data[patch[1]:patch[3], patch[0]:patch[2]]
+        # in the coordinates of the file, also behind an earlier crop
+        if 'crop_window' in results:
+            patch = patch + np.tile(results['crop_window'][:2], 2)
+        results['crop_window'] = patch
 
-            results['input'] = input_data
-            results['ori_shape'] = input_data.shape
+        results['input'] = input_data
+        results['ori_shape'] = input_data.shape
 
-            return results
-        return None
+        return results
 
     def __repr__(self):
         return self.__class__.__name__ + '(crop_size={}, to_clear={})'.format(self.crop_size, self.to_clear)
@@ -146,7 +231,9 @@ class Pad(object):
         results['pad_shape'] = padded_data.shape
 
         # adjust masks
-        if 'gt_masks' in results:
+        if isinstance(results.get('gt_masks'), LazyMasks):
+            results['gt_masks'] = results['gt_masks'].pad(pad_shape)
+        elif 'gt_masks' in results:
             padded_masks = [pad2d(mask, pad_shape, 0) for mask in results['gt_masks']]
             results['gt_masks'] = np.stack(padded_masks, axis=0)
 
@@ -211,12 +298,82 @@ class TargetFromRepair(object):
         return self.__class__.__name__ + '(block_range={}, fill_value={})'.format(self.block_range, self.fill_value)
 
 
+def motion_kernel(angle, degree):
+    # 模糊kernel，degree越大，越模糊
+    kernel = np.diag(np.ones(degree))
+    M = cv.getRotationMatrix2D((degree / 2, degree / 2), angle, 1)
+    kernel = cv.warpAffine(kernel, M, (degree, degree))
+    kernel = kernel / degree
+    return kernel
+
+
+def kernel_blocks(kernel, block_size=11):
+    blocks = []
+    for y in range(0, kernel.shape[0], block_size):
+        for x in range(0, kernel.shape[1], block_size):
+            block = kernel[y:y + block_size, x:x + block_size]
+            if np.any(block):
+                blocks.append((y, x, np.ascontiguousarray(block)))
+    return blocks
+
+
+def blocked_filter2d(data, kernel, blocks):
+    # cv.filter2D switches to a DFT above 11x11 kernels, a motion kernel is a thin
+    # line so a few direct passes over its non-empty blocks are much cheaper
+    kh, kw = kernel.shape
+    h, w = data.shape
+    padded = cv.copyMakeBorder(data, kh // 2, kh - 1 - kh // 2, kw // 2, kw - 1 - kw // 2, cv.BORDER_REFLECT_101)
+
+    output = None
+    for y, x, block in blocks:
+        sub = padded[y:y + h + block.shape[0] - 1, x:x + w + block.shape[1] - 1]
+        block_output = cv.filter2D(sub, -1, block, anchor=(0, 0), borderType=cv.BORDER_CONSTANT)[:h, :w]
+        if output is None:
+            output = block_output.copy()
+        else:
+            output += block_output
+    return output
+
+
+class MotionKernelBank(object):
+
+    def __init__(self, degree=(10, 20), max_bytes=64 << 20):
+        self.degree = degree
+        self.max_bytes = max_bytes
+        self._kernels = OrderedDict()
+        self._nbytes = 0
+
+        # the whole range is built once if it fits, otherwise kernels are kept LRU
+        if 2 * 4 * 360 * sum(d * d for d in range(*degree)) <= max_bytes:
+            for d in range(*degree):
+                for angle in range(360):
+                    self.get(angle, d)
+
+    def get(self, angle, degree):
+        key = (angle, degree)
+        item = self._kernels.get(key)
+        if item is not None:
+            self._kernels.move_to_end(key)
+            return item
+
+        kernel = motion_kernel(angle, degree).astype(np.float32)
+        item = (kernel, kernel_blocks(kernel))
+        self._kernels[key] = item
+        self._nbytes += 2 * kernel.nbytes
+        while self._nbytes > self.max_bytes and len(self._kernels) > 1:
+            _, (old_kernel, _) = self._kernels.popitem(last=False)
+            self._nbytes -= 2 * old_kernel.nbytes
+        return item
+
+
 @PIPELINES.register_module
 class TargetFromMotion(object):
 
-    def __init__(self, invariant_prob=0.1, degree=(10, 20)):
+    def __init__(self, invariant_prob=0.1, degree=(10, 20), max_blocks=6):
         self.invariant_prob = invariant_prob
         self.degree = degree
+        self.max_blocks = max_blocks
+        self.kernels = MotionKernelBank(degree)
 
     def __call__(self, results):
         input_data = results['input']
@@ -226,14 +383,14 @@ class TargetFromMotion(object):
             angle = np.random.randint(0, 360)
             degree = np.random.randint(*self.degree)
 
-            # 模糊kernel，degree越大，越模糊
-            kernel = np.diag(np.ones(degree))
-            M = cv.getRotationMatrix2D((degree / 2, degree / 2), angle, 1)
-            kernel = cv.warpAffine(kernel, M, (degree, degree))
-            kernel = kernel / degree
+            kernel, blocks = self.kernels.get(angle, degree)
+            if input_data.dtype == np.float32 and 1 < len(blocks) <= self.max_blocks:
+                input_data = blocked_filter2d(input_data, kernel, blocks)
+            else:
+                input_data = cv.filter2D(input_data, -1, kernel)
 
-            input_data = cv.filter2D(input_data, -1, kernel)
-            cv.normalize(input_data, input_data, target_data.min(), target_data.max(), cv.NORM_MINMAX)
+            a, b = cv.minMaxLoc(target_data)[:2]
+            cv.normalize(input_data, input_data, a, b, cv.NORM_MINMAX)
 
         results['input'] = input_data
         results['target'] = target_data
@@ -241,4 +398,5 @@ class TargetFromMotion(object):
         return results
 
     def __repr__(self):
-        return self.__class__.__name__ + '(invariant_prob={}, degree={})'.format(self.invariant_prob, self.degree)
+        return self.__class__.__name__ + '(invariant_prob={}, degree={}, max_blocks={})'.format(
+            self.invariant_prob, self.degree, self.max_blocks)
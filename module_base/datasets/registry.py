@@ -2,3 +2,4 @@ from utils import Registry
 
 DATASETS = Registry('dataset')
 PIPELINES = Registry('pipeline')
+BATCH_PIPELINES = Registry('batch_pipeline')
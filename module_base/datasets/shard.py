@@ -0,0 +1,81 @@
+import json
+import numpy as np
+import os.path as osp
+from .coco import CocoDataset, CocoIndex
+from .registry import DATASETS
+
+'''
+Serves slices packed by `tools/pack_shards.py`.
+`ann_file` is the shard `index.json`, shard files live next to it.
+Shards are mapped read-only: a worker keeps its mapping for its whole life,
+so a transform writing into the slice would change every later read of it;
+`LoadDicomFromFile` copies the view before the pipeline runs.
+'''
+
+
+@DATASETS.register_module
+class ShardDataset(CocoDataset):
+
+    def __init__(self, ann_file, data_root, pipeline, profile_interval=0, rle_cfg=None):
+        super(ShardDataset, self).__init__(ann_file, data_root, pipeline, profile_interval, rle_cfg)
+        self.shard_dir = osp.dirname(self.ann_file)
+        self._shards = {}
+
+    def __getstate__(self):
+        # memmaps are opened lazily in every worker, never pickled
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def load_annotations(self, ann_file):
+        with open(ann_file, 'r') as f:
+            coco = json.load(f)
+
+        images = coco['images']
+        self.shard_names = coco['shards']
+        self.dtype_names = sorted(set(img['dtype'] for img in images))
+
+        shard_inds = {name: i for i, name in enumerate(self.shard_names)}
+        dtype_inds = {name: i for i, name in enumerate(self.dtype_names)}
+        self.img_shards = np.array([shard_inds[img['shard']] for img in images], dtype=np.int32)
+        self.img_dtypes = np.array([dtype_inds[img['dtype']] for img in images], dtype=np.int32)
+        self.img_offsets = np.array([img['offset'] for img in images], dtype=np.int64)
+        self.img_shapes = np.array([img['shape'] for img in images], dtype=np.int64).reshape(-1, 2)
+
+        # slices packed with `--native` keep stored pixels plus slope/intercept
+        self.img_rescale = None
+        if images and 'rescale' in images[0]:
+            self.img_rescale = np.array([[img['rescale']['slope'], img['rescale']['intercept']] for img in images],
+                                        dtype=np.float64)
+
+        return CocoIndex(coco)
+
+    def get_img_shapes(self):
+        return self.img_shapes
+
+    def _get_shard(self, shard_ind):
+        shard = self._shards.get(shard_ind)
+        if shard is None:
+            filename = osp.join(self.shard_dir, self.shard_names[shard_ind])
+            shard = np.memmap(filename, dtype=np.uint8, mode='r')
+            self._shards[shard_ind] = shard
+        return shard
+
+    def load_slice(self, idx):
+        dtype = np.dtype(self.dtype_names[self.img_dtypes[idx]])
+        shape = tuple(self.img_shapes[idx].tolist())
+        offset = int(self.img_offsets[idx])
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+
+        shard = self._get_shard(int(self.img_shards[idx]))
+        return shard[offset:offset + nbytes].view(dtype).reshape(shape)
+
+    def prepare_train(self, idx):
+        img_info = self.dataset.img_info(idx)
+        ann_info = self.parse_ann_info(idx)
+        img_data = self.load_slice(idx)
+        results = dict(data_root=self.data_root, img_info=img_info, ann_info=ann_info, img_data=img_data)
+        if self.img_rescale is not None:
+            slope, intercept = self.img_rescale[idx].tolist()
+            results['rescale'] = dict(slope=slope, intercept=intercept)
+        return self.pipeline(results)
@@ -1,3 +1,7 @@
+from .base import BaseModel
+from .dcnn import DCNN, ResNet
+from .deploy import TorchScriptModel, OnnxModel
 from .registry import MODELS
+from .tiling import tiled_inference
 
-__all__ = ['MODELS']
+__all__ = ['BaseModel', 'DCNN', 'ResNet', 'TorchScriptModel', 'OnnxModel', 'MODELS', 'tiled_inference']
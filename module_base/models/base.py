@@ -1,17 +1,28 @@
 import torch.nn as nn
+from .tiling import tiled_inference
 
 
 class BaseModel(nn.Module):
 
-    def __init__(self):
+    def __init__(self, test_cfg=None):
         super(BaseModel, self).__init__()
+        # e.g. test_cfg=dict(tile_cfg=dict(tile_size=512, overlap=64, margin=16, tiles_per_batch=4))
+        self.test_cfg = test_cfg or {}
 
     def forward_train(self, input, target, data_meta, **kwargs):
         pass
 
-    def simple_test(self, input, target, data_meta, **kwargs):
+    def forward_test(self, input):
         pass
 
+    def simple_test(self, input, target, data_meta, **kwargs):
+        tile_cfg = self.test_cfg.get('tile_cfg')
+        if tile_cfg is None:
+            return self.forward_test(input)
+        param = next(self.parameters(), None)
+        device = param.device if param is not None else None
+        return tiled_inference(self.forward_test, input, device=device, **tile_cfg)
+
     def forward(self, input, target, data_meta, return_loss=True, **kwargs):
         if return_loss:
             return self.forward_train(input, target, data_meta, **kwargs)
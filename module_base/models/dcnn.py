@@ -1,15 +1,99 @@
 import torch.nn as nn
+from utils import build_from_cfg
+from .base import BaseModel
 from .registry import MODELS
 
+'''
+ResNet generator (Johnson et al., as in pix2pix / CycleGAN): 7x7 stem, two
+stride-2 downsamplings, `depth` residual blocks, two upsamplings, 7x7 head.
+Inputs must be divisible by 4, e.g. `Pad(size_divisor=4)` or `tile_cfg`.
+'''
+
+
+def conv_layers(in_channels, out_channels, kernel_size, padding_type='reflect', stride=1, bias=False):
+    # convs followed by BatchNorm need no bias
+    padding = kernel_size // 2
+    if padding_type == 'reflect':
+        return [nn.ReflectionPad2d(padding), nn.Conv2d(in_channels, out_channels, kernel_size, stride, bias=bias)]
+    elif padding_type == 'replicate':
+        return [nn.ReplicationPad2d(padding), nn.Conv2d(in_channels, out_channels, kernel_size, stride, bias=bias)]
+    elif padding_type == 'zero':
+        return [nn.Conv2d(in_channels, out_channels, kernel_size, stride, padding, bias=bias)]
+    raise NotImplementedError('padding [{}] is not found'.format(padding_type))
+
+
+def conv_bn_relu(in_channels, out_channels, kernel_size, padding_type='reflect', stride=1):
+    return conv_layers(in_channels, out_channels, kernel_size, padding_type, stride) + \
+        [nn.BatchNorm2d(out_channels), nn.ReLU(inplace=True)]
+
+
+class ResBlock(nn.Module):
+
+    def __init__(self, channels, padding_type='reflect'):
+        super(ResBlock, self).__init__()
+        layers = conv_bn_relu(channels, channels, 3, padding_type)
+        layers += conv_layers(channels, channels, 3, padding_type) + [nn.BatchNorm2d(channels)]
+        self.block = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return x + self.block(x)
+
 
 @MODELS.register_module
-class DCNN(object):
+class ResNet(nn.Module):
 
     def __init__(self,
-                 type='ResNet',
                  depth=9,
                  in_channels=1,
                  out_channels=1,
+                 base_channels=64,
+                 num_downs=2,
                  padding_type='reflect',
                  upsampling='bilinear'):
-        super(DCNN, self).__init__()
+        super(ResNet, self).__init__()
+        layers = conv_bn_relu(in_channels, base_channels, 7, padding_type)
+
+        channels = base_channels
+        for _ in range(num_downs):
+            layers += conv_bn_relu(channels, channels * 2, 3, 'zero', stride=2)
+            channels *= 2
+
+        layers += [ResBlock(channels, padding_type) for _ in range(depth)]
+
+        for _ in range(num_downs):
+            if upsampling == 'transpose':
+                layers += [nn.ConvTranspose2d(channels, channels // 2, 3, 2, 1, output_padding=1, bias=False),
+                           nn.BatchNorm2d(channels // 2), nn.ReLU(inplace=True)]
+            else:
+                align_corners = None if upsampling == 'nearest' else False
+                layers += [nn.Upsample(scale_factor=2, mode=upsampling, align_corners=align_corners)]
+                layers += conv_bn_relu(channels, channels // 2, 3, padding_type)
+            channels //= 2
+
+        layers += conv_layers(channels, out_channels, 7, padding_type, bias=True)
+        self.layers = nn.Sequential(*layers)
+
+    def forward(self, x):
+        return self.layers(x)
+
+
+@MODELS.register_module
+class DCNN(BaseModel):
+
+    def __init__(self, net, loss='L1', test_cfg=None):
+        super(DCNN, self).__init__(test_cfg)
+        self.net = build_from_cfg(net, MODELS)
+
+        loss = loss.lower()
+        if loss == 'l1':
+            self.loss = nn.L1Loss()
+        elif loss == 'l2':
+            self.loss = nn.MSELoss()
+        else:
+            raise NotImplementedError('loss [{}] is not found'.format(loss))
+
+    def forward_train(self, input, target, data_meta, **kwargs):
+        return dict(loss=self.loss(self.net(input), target))
+
+    def forward_test(self, input):
+        return self.net(input)
@@ -0,0 +1,42 @@
+import torch
+from .base import BaseModel
+from .registry import MODELS
+
+'''
+Exported models (see tools/export_model.py) behind the `BaseModel` test
+interface, so `test_cfg` tiling applies to every backend:
+    deploy_cfg = dict(type='TorchScriptModel')  # fp32 or int8 `.pt`
+    deploy_cfg = dict(type='OnnxModel')         # pip install onnxruntime
+`file` is the exported model, tools pass their checkpoint argument.
+'''
+
+
+@MODELS.register_module
+class TorchScriptModel(BaseModel):
+
+    def __init__(self, file, test_cfg=None, num_threads=None):
+        super(TorchScriptModel, self).__init__(test_cfg)
+        self.module = torch.jit.load(file, map_location='cpu')
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def forward_test(self, input):
+        return self.module(input)
+
+
+@MODELS.register_module
+class OnnxModel(BaseModel):
+
+    def __init__(self, file, test_cfg=None, num_threads=None):
+        super(OnnxModel, self).__init__(test_cfg)
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(file, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def forward_test(self, input):
+        output = self.session.run(None, {self.input_name: input.detach().cpu().float().numpy()})[0]
+        return torch.from_numpy(output).to(input.device)
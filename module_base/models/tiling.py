@@ -0,0 +1,83 @@
+import math
+import torch
+
+'''
+Sliding-window inference for image-to-image models.
+
+Tiles of `tile_size` overlap by `overlap` pixels and are blended with a
+per-pixel weight (a linear ramp across the overlap, or a gaussian), so seams
+fade out. The `margin` pixels along a tile side inside the image see the
+tile's padding instead of the neighbouring pixels, they get zero weight and
+the ramp starts after them: set it to half the receptive field of the model,
+`overlap` has to be larger than twice the margin. The output and weight sums live on the device of `input` (keep a
+full-resolution slice on the cpu), only `tiles_per_batch` tiles are on the
+model's device at a time.
+'''
+
+
+def tile_starts(size, tile, overlap):
+    if size <= tile:
+        return [0]
+    stride = max(tile - overlap, 1)
+    num = int(math.ceil((size - tile) / stride)) + 1
+    # spread the tiles evenly, the last one ends at the border
+    return [int(round(i * (size - tile) / (num - 1))) for i in range(num)]
+
+
+def blend_window(tile, overlap, mode='linear', margin=0, inner=(True, True), dtype=torch.float32, device=None):
+    # `inner`: whether the (start, end) side of the tile lies inside the image,
+    # sides on the image border keep their full weight
+    pos = torch.arange(tile, dtype=dtype, device=device) + 0.5
+    if mode == 'gaussian':
+        sigma = tile / 8.
+        window = torch.exp(-0.5 * ((pos - tile / 2.) / sigma) ** 2).clamp(min=1e-4)
+        ramp = (pos > margin).to(dtype)
+    elif mode == 'linear' and overlap > 0:
+        window = torch.ones(tile, dtype=dtype, device=device)
+        ramp = ((pos - margin) / (overlap - 2 * margin)).clamp(0., 1.)
+    else:
+        return torch.ones(tile, dtype=dtype, device=device)
+
+    if inner[0]:
+        window = window * ramp
+    if inner[1]:
+        window = window * ramp.flip(0)
+    return window
+
+
+def tiled_inference(fn, input, tile_size=512, overlap=64, margin=None, tiles_per_batch=4, blend='linear',
+                    device=None):
+    n, _, h, w = input.shape
+    th, tw = min(tile_size, h), min(tile_size, w)
+    ys, xs = tile_starts(h, th, overlap), tile_starts(w, tw, overlap)
+
+    margin = overlap // 4 if margin is None else margin
+    windows = []
+    for starts, tile, size in ((ys, th, h), (xs, tw, w)):
+        tile_overlap = min(overlap, tile // 2)
+        if len(starts) > 1 and tile_overlap <= 2 * margin:
+            raise ValueError('overlap {} must be larger than twice the margin {}'.format(tile_overlap, margin))
+        windows.append({s: blend_window(tile, tile_overlap, blend, margin, (s > 0, s + tile < size),
+                                        input.dtype, input.device) for s in starts})
+    wy, wx = windows
+
+    tiles = [(i, y, x) for i in range(n) for y in ys for x in xs]
+    output, norm = None, input.new_zeros((h, w))
+    for y in ys:
+        for x in xs:
+            norm[y:y + th, x:x + tw] += wy[y][:, None] * wx[x][None, :]
+
+    with torch.no_grad():
+        for k in range(0, len(tiles), tiles_per_batch):
+            chunk = tiles[k:k + tiles_per_batch]
+            batch = torch.stack([input[i, :, y:y + th, x:x + tw] for i, y, x in chunk], 0)
+            if device is not None:
+                batch = batch.to(device, non_blocking=True)
+            pred = fn(batch).to(input.device)
+
+            if output is None:
+                output = input.new_zeros((n, pred.size(1), h, w), dtype=pred.dtype)
+            for (i, y, x), p in zip(chunk, pred):
+                output[i, :, y:y + th, x:x + tw].addcmul_(p, wy[y][:, None] * wx[x][None, :])
+
+    return output.div_(norm)
@@ -1,5 +1,6 @@
 from .env import Cache, get_root_logger
+from .disk_lru import DiskLRU
 from .registry import Registry, build_from_cfg
 
-__all__ = ['Cache', 'get_root_logger',
+__all__ = ['Cache', 'get_root_logger', 'DiskLRU',
            'Registry', 'build_from_cfg']
@@ -0,0 +1,96 @@
+import os
+import time
+import tempfile
+import os.path as osp
+
+'''
+Byte-bounded LRU over the files of one directory, shared by every process that
+writes to it. Entries are written through a unique tmp file (`mkstemp`, safe for
+threads of one process too) and `os.replace`, so readers never observe a partial
+file; the mtime of an entry is its LRU clock (`touch` on every hit). Each process
+rescans the directory after writing `max_bytes // 32` bytes and evicts the
+oldest entries down to 90%, plus tmp files that crashed writers left behind.
+'''
+
+
+class DiskLRU(object):
+
+    def __init__(self, cache_dir, max_bytes, suffix, companions=(), tmp_timeout=3600):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        # seconds after which an unfinished tmp file counts as abandoned
+        self.tmp_timeout = tmp_timeout
+        # files next to an entry that go with it, e.g. '.json' meta
+        self.companions = companions
+        # bytes this process wrote since it last scanned the cache directory,
+        # starts full so that the first write measures what other runs left
+        self._pending = max_bytes
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, key):
+        return osp.join(self.cache_dir, key + self.suffix)
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def write(self, path, write_fn):
+        try:
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        except OSError:
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # mkstemp creates 0600, other users of a shared cache have to read it
+                os.fchmod(fd, 0o644)
+                write_fn(f)
+            os.replace(tmp_path, path)
+        except OSError:
+            if osp.exists(tmp_path):
+                os.remove(tmp_path)
+            return False
+        return True
+
+    def added(self, nbytes):
+        self._pending += nbytes
+        if self._pending >= self.max_bytes // 32:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        stale = time.time() - self.tmp_timeout
+        for entry in os.scandir(self.cache_dir):
+            is_tmp = entry.name.endswith('.tmp')
+            if not (is_tmp or entry.name.endswith(self.suffix)):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            if not is_tmp:
+                entries.append((st.st_mtime, st.st_size, entry.path))
+            elif st.st_mtime < stale:
+                # nobody writes to it anymore, a writer died before `os.replace`
+                try:
+                    os.remove(entry.path)
+                except OSError:
+                    pass
+
+        total = sum(e[1] for e in entries)
+        if total > self.max_bytes:
+            low_watermark = int(self.max_bytes * 0.9)
+            for _, size, path in sorted(entries):
+                stem = path[:-len(self.suffix)]
+                for p in [path] + [stem + c for c in self.companions]:
+                    try:
+                        os.remove(p)
+                    except OSError:
+                        pass  # removed by another process, or no companion
+                total -= size
+                if total <= low_watermark:
+                    break
+        self._pending = 0
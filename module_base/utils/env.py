@@ -1,24 +1,160 @@
 import os
 import time
 import logging
+import math
 import numpy as np
-from collections import defaultdict
+import torch
+import torch.distributed as dist
+
+
+def _as_float64(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().reshape(-1).to(torch.float64)
+    return torch.as_tensor(np.asarray(value, dtype=np.float64).reshape(-1))
+
+
+class RunningStat(object):
+    # count / mean / M2 / min / max (Welford, batches merged with Chan et al.)
+    # plus a fixed-size reservoir sample for quantiles; tensors stay on their
+    # device, nothing is read back before `state`
+
+    def __init__(self, reservoir_size=0):
+        self.reservoir_size = reservoir_size
+        self.count = 0
+        self.mean = self.m2 = self.min = self.max = None
+        self.sample = None
+        self.sample_size = 0
+
+    def _merge_moments(self, n, mean, m2, lo, hi):
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.min, self.max = n, mean, m2, lo, hi
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * (n / total)
+        self.m2 = self.m2 + m2 + delta * delta * (self.count * n / total)
+        self.min = torch.min(self.min, lo.to(self.min.device))
+        self.max = torch.max(self.max, hi.to(self.max.device))
+        self.count = total
+
+    def _reservoir(self, values):
+        # algorithm R, the positions are drawn on the host so the values never sync
+        if self.sample is None:
+            self.sample = values.new_empty(self.reservoir_size)
+        n = values.numel()
+        free = min(self.reservoir_size - self.sample_size, n)
+        if free > 0:
+            self.sample[self.sample_size:self.sample_size + free] = values[:free]
+            self.sample_size += free
+        if n > free:
+            pos = self.count - n + free + 1 + np.arange(n - free)
+            slots = (np.random.rand(n - free) * pos).astype(np.int64)
+            keep = np.flatnonzero(slots < self.reservoir_size)
+            # a slot drawn twice in one batch keeps the later value, as if added one by one
+            slots, last = np.unique(slots[keep][::-1], return_index=True)
+            keep = keep[::-1][last]
+            if len(keep):
+                self.sample[torch.from_numpy(slots).to(self.sample.device)] = \
+                    values[torch.from_numpy(keep + free).to(values.device)].to(self.sample.device)
+
+    def update(self, value):
+        values = _as_float64(value)
+        n = values.numel()
+        if n == 0:
+            return
+        mean = values.mean()
+        self._merge_moments(n, mean, (values - mean).pow(2).sum(), values.min(), values.max())
+        if self.reservoir_size:
+            self._reservoir(values)
+
+    def state(self):
+        # plain python values, picklable for workers and ranks
+        if self.count == 0:
+            return dict(count=0)
+        moments = torch.stack([self.mean, self.m2, self.min, self.max]).tolist()
+        state = dict(zip(('mean', 'm2', 'min', 'max'), moments), count=self.count)
+        if self.sample is not None:
+            state['sample'] = self.sample[:self.sample_size].tolist()
+        return state
+
+    def merge(self, state):
+        if state['count'] == 0:
+            return
+        count = self.count
+        device = self.mean.device if self.mean is not None else None
+        moments = torch.tensor([state['mean'], state['m2'], state['min'], state['max']], dtype=torch.float64,
+                               device=device)
+        self._merge_moments(state['count'], *moments)
+
+        if self.reservoir_size and 'sample' in state:
+            # keep each side in proportion to the number of values it stands for
+            ours = self.sample[:self.sample_size].tolist() if self.sample is not None else []
+            theirs = state['sample']
+            k = min(self.reservoir_size, len(ours) + len(theirs))
+            num_ours = min(np.random.binomial(k, count / self.count), len(ours))
+            num_ours = max(num_ours, k - len(theirs))
+            merged = list(np.random.permutation(ours)[:num_ours]) + list(np.random.permutation(theirs)[:k - num_ours])
+            self.sample = moments.new_zeros(self.reservoir_size)
+            self.sample[:k] = torch.tensor(merged, dtype=torch.float64)
+            self.sample_size = k
+
+    def result(self, quantiles=()):
+        state = self.state()
+        if state['count'] == 0:
+            return dict(count=0)
+        result = dict(count=state['count'], mean=state['mean'], min=state['min'], max=state['max'],
+                      std=math.sqrt(max(state['m2'], 0.) / state['count']))
+        if quantiles and state.get('sample'):
+            for q, v in zip(quantiles, np.quantile(state['sample'], quantiles)):
+                result['p{:g}'.format(q * 100)] = float(v)
+        return result
 
 
 class Cache(object):
+    # constant memory per key: values (floats or tensors of any shape) go into a
+    # RunningStat; `state` / `merge` / `all_reduce` combine caches of workers or ranks
+
+    def __init__(self, quantiles=(), reservoir_size=1024):
+        self.quantiles = tuple(quantiles)
+        self.reservoir_size = reservoir_size if self.quantiles else 0
+        self.data = {}
 
-    def __init__(self):
-        self.data = defaultdict(list)
+    def _stat(self, key):
+        if key not in self.data:
+            self.data[key] = RunningStat(self.reservoir_size)
+        return self.data[key]
 
     def keep(self, **kwargs):
         for k, v in kwargs.items():
-            self.data[k].append(v)
+            self._stat(k).update(v)
+
+    def state(self):
+        return {k: s.state() for k, s in self.data.items()}
+
+    def merge(self, state):
+        for k, s in state.items():
+            self._stat(k).merge(s)
+
+    def all_reduce(self):
+        if not (dist.is_available() and dist.is_initialized()):
+            return
+        states = [None] * dist.get_world_size()
+        dist.all_gather_object(states, self.state())
+        self.data = {}
+        for state in states:
+            self.merge(state)
+
+    def stats(self):
+        return {k: s.result(self.quantiles) for k, s in self.data.items()}
 
     def summary(self, num):
-        data = [(k, np.mean(self.data[k])) for k in sorted(self.data)]
-        message = ['{}:{:.6f}'.format(k, v) for k, v in data]
+        message = []
+        for k, r in sorted(self.stats().items()):
+            if r['count']:
+                message.append('{}:{:.6f}'.format(k, r['mean']))
+                message.extend('{}@{}:{:.6f}'.format(k, q, v) for q, v in sorted(r.items()) if q.startswith('p'))
         message = '{}/{}'.format(num, ','.join(message))
-        self.data = defaultdict(list)
+        self.data = {}
         return message
 
 
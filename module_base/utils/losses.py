@@ -1,7 +1,11 @@
+import hashlib
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.models as models
+from collections import OrderedDict
+from contextlib import ExitStack
+from .disk_lru import DiskLRU
 
 """
 参考：
@@ -40,48 +44,139 @@ def loss_hinge_gen(dis_fake):
 # https://github.com/richzhang/PerceptualSimilarity/blob/master/models/pretrained_networks.py
 
 
-class VGGFeatureExtractor(nn.Module):
-    def __init__(self):
-        super(VGGFeatureExtractor, self).__init__()
-        model = models.vgg19(pretrained=True)
-        features = list(model.features.children())
-        self.features = nn.Sequential(*features[:35])
+def fold_rgb_conv(conv):
+    # conv(cat([x, x, x])) == conv with its weights summed over the input channels
+    folded = nn.Conv2d(1, conv.out_channels, conv.kernel_size, conv.stride, conv.padding, conv.dilation,
+                       conv.groups, conv.bias is not None, conv.padding_mode)
+    folded.weight.data.copy_(conv.weight.data.sum(1, keepdim=True))
+    if conv.bias is not None:
+        folded.bias.data.copy_(conv.bias.data)
+    return folded
+
+
+class LayerFeatureExtractor(nn.Module):
+    # runs `layers` up to the deepest of `out_layers` and returns the output of each
+    # of them, unflattened; the first layer must be the conv on the RGB input
+    def __init__(self, layers, out_layers, in_channels=1, channels_last=False, dtype=None):
+        super(LayerFeatureExtractor, self).__init__()
+        self.out_layers = sorted(set(out_layers))
+        self.in_channels = in_channels
+        self.channels_last = channels_last
+        self.dtype = dtype
+
+        layers = list(layers)[:self.out_layers[-1] + 1]
+        self.rgb_conv = None
+        if in_channels == 1:
+            # 3-channel input still goes through the original conv
+            self.rgb_conv = layers[0]
+            layers[0] = fold_rgb_conv(layers[0])
+        for i in self.out_layers[:-1]:
+            # an in-place ReLU right after a returned layer would overwrite it
+            if getattr(layers[i + 1], 'inplace', False):
+                layers[i + 1].inplace = False
+        self.features = nn.Sequential(*layers)
         # No need to BP to variable
-        for k, v in self.features.named_parameters():
+        for k, v in self.named_parameters():
             v.requires_grad = False
 
+        if channels_last:
+            self.to(memory_format=torch.channels_last)
+
     def forward(self, input):
-        if input.size(1) == 1:
-            input = torch.cat((input, input, input), 1)
-        output = self.features(input)
-        return output.view(output.size(0), -1)
+        if input.size(1) == 1 and self.in_channels != 1:
+            input = input.expand(-1, self.in_channels, -1, -1)
+        if self.channels_last:
+            input = input.contiguous(memory_format=torch.channels_last)
+
+        outputs = []
+        with ExitStack() as stack:
+            if self.dtype is not None and hasattr(torch, 'autocast'):
+                stack.enter_context(torch.autocast(input.device.type, dtype=self.dtype))
+            for i, layer in enumerate(self.features):
+                if i == 0 and self.rgb_conv is not None and input.size(1) == 3:
+                    layer = self.rgb_conv
+                input = layer(input)
+                if i in self.out_layers:
+                    outputs.append(input.float() if self.dtype is not None else input)
+        return outputs
+
+
+class VGGFeatureExtractor(LayerFeatureExtractor):
+    def __init__(self, layers=(34,), **kwargs):
+        model = models.vgg19(pretrained=True)
+        super(VGGFeatureExtractor, self).__init__(model.features.children(), layers, **kwargs)
 
 
-class ResNet101FeatureExtractor(nn.Module):
-    def __init__(self):
-        super(ResNet101FeatureExtractor, self).__init__()
+class ResNet101FeatureExtractor(LayerFeatureExtractor):
+    def __init__(self, layers=(7,), **kwargs):
         model = models.resnet101(pretrained=True)
-        features = list(model.children())
-        self.features = nn.Sequential(*features[:8])
-        # No need to BP to variable
-        for k, v in self.features.named_parameters():
-            v.requires_grad = False
-
-    def forward(self, input):
-        if input.size(1) == 1:
-            input = torch.cat([input, input, input], 1)
-        output = self.features(input)
-        return output.view(output.size(0), -1)
+        super(ResNet101FeatureExtractor, self).__init__(model.children(), layers, **kwargs)
+
+
+def _nbytes(feats):
+    return sum(feat.numel() * feat.element_size() for feat in feats)
+
+
+class FeatureCache(object):
+    # bounded LRU of per-sample target features (one tensor per layer), in RAM or
+    # as `<sha1>.pt` files in a `DiskLRU` under `cache_dir`, shared by all processes
+
+    def __init__(self, max_bytes=4 << 30, cache_dir=None, dtype=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.lru = DiskLRU(cache_dir, max_bytes, '.pt') if cache_dir is not None else None
+
+    def _path(self, key):
+        return self.lru.path(hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        if self.lru is None:
+            feats = self.items.get(key)
+            if feats is not None:
+                self.items.move_to_end(key)
+            return feats
+
+        path = self._path(key)
+        try:
+            feats = torch.load(path)
+        except (OSError, RuntimeError, EOFError):
+            return None
+        self.lru.touch(path)
+        return feats
+
+    def put(self, key, feats):
+        feats = [feat.detach().to('cpu', dtype=self.dtype or feat.dtype).clone() for feat in feats]
+        size = _nbytes(feats)
+
+        if self.lru is None:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.nbytes -= _nbytes(old)
+            self.items[key] = feats
+            self.nbytes += size
+            while self.nbytes > self.max_bytes and len(self.items) > 1:
+                _, old = self.items.popitem(last=False)
+                self.nbytes -= _nbytes(old)
+            return
+
+        if self.lru.write(self._path(key), lambda f: torch.save(feats, f)):
+            self.lru.added(size)
 
 
 class PerceptualLoss(nn.Module):
-    def __init__(self, net="vgg19", loss="L2", device="cuda"):
+    def __init__(self, net="vgg19", loss="L2", device="cuda", fused=False, inference=False, cache_cfg=None,
+                 net_cfg=None):
         super(PerceptualLoss, self).__init__()
         net = net.lower()
+        # e.g. net_cfg=dict(layers=(3, 8, 17), channels_last=True, dtype=torch.bfloat16)
+        net_cfg = net_cfg or {}
         if net == "vgg19":
-            self.net = VGGFeatureExtractor().to(device)
+            self.net = VGGFeatureExtractor(**net_cfg).to(device)
         elif net == "resnet101":
-            self.net = ResNet101FeatureExtractor().to(device)
+            self.net = ResNet101FeatureExtractor(**net_cfg).to(device)
         else:
             raise NotImplementedError("Net [%s] is not found" % net)
 
@@ -95,8 +190,61 @@ class PerceptualLoss(nn.Module):
 
         self.net.eval()
 
-    def __call__(self, fake, real):
-        pred_fake = self.net(fake)
-        pred_real = self.net(real)
-        loss = self.loss(pred_fake, pred_real.detach())
-        return loss
+        # fake and real through the extractor as one batch
+        self.fused = fused
+        # real (target) features under inference_mode, only without `fused`
+        self.inference = inference
+        # target features by sample, `key_fields` of data_meta must identify the
+        # target content, e.g. ('filename', 'crop_window') with random crops
+        # (Collect them as meta_keys); there is no default that is safe
+        self.cache = None
+        if cache_cfg is not None:
+            cache_cfg = dict(cache_cfg)
+            if 'key_fields' not in cache_cfg:
+                raise KeyError('cache_cfg needs `key_fields`, the data_meta keys that identify a target')
+            self.key_fields = tuple(cache_cfg.pop('key_fields'))
+            self.cache = FeatureCache(**cache_cfg)
+
+    def _features(self, fake, real):
+        if real is None or not len(real):
+            return self.net(fake), None
+        if not self.fused:
+            return self.net(fake), self._target_features(real)
+
+        # one launch per layer for both halves, gradients only reach `fake`
+        pred = self.net(torch.cat([fake, real.detach()], 0))
+        return [p[:fake.size(0)] for p in pred], [p[fake.size(0):].detach() for p in pred]
+
+    def _target_features(self, real):
+        if self.inference and hasattr(torch, 'inference_mode'):
+            with torch.inference_mode():
+                pred_real = self.net(real)
+            # inference tensors cannot be saved for backward by the loss
+            return [p.clone() for p in pred_real]
+        with torch.no_grad():
+            return self.net(real)
+
+    def _loss(self, pred_fake, pred_real):
+        return sum(self.loss(f, r) for f, r in zip(pred_fake, pred_real))
+
+    def _cache_keys(self, data_meta, num):
+        fields = [data_meta[k] for k in self.key_fields]
+        return [tuple(repr(field[i]) for field in fields) for i in range(num)]
+
+    def __call__(self, fake, real, data_meta=None):
+        if self.cache is None or data_meta is None:
+            return self._loss(*self._features(fake, real))
+
+        keys = self._cache_keys(data_meta, fake.size(0))
+        cached = [self.cache.get(key) for key in keys]
+        missing = [i for i, feat in enumerate(cached) if feat is None]
+
+        pred_fake, pred_missing = self._features(fake, real[missing] if missing else None)
+        for j, i in enumerate(missing):
+            cached[i] = [p[j] for p in pred_missing]
+            self.cache.put(keys[i], cached[i])
+
+        # hits come back on the cpu, fresh targets are still on the loss device
+        pred_real = [torch.stack([feats[l].to(p.device, p.dtype, non_blocking=True) for feats in cached], 0)
+                     for l, p in enumerate(pred_fake)]
+        return self._loss(pred_fake, pred_real)
@@ -0,0 +1,76 @@
+import torch
+import torch.nn.functional as F
+
+'''
+Image quality metrics on whole batches, all return one value per sample:
+    input: Tensor(N, C, H, W), values in the original (denormalized) units
+
+SSIM follows skimage.metrics.structural_similarity(gaussian_weights=True,
+sigma=1.5, use_sample_covariance=False): an 11x11 gaussian applied as two
+1-d convolutions, only windows fully inside the image are averaged.
+'''
+
+
+def denormalize(data, norm_cfg):
+    # undo NormalizeCustomize / NormalizeInstance, norm_cfg: [dict(mean, std)] per sample
+    shape = (-1,) + (1,) * (data.dim() - 1)
+    mean = torch.tensor([float(c['mean']) for c in norm_cfg], device=data.device, dtype=data.dtype).view(shape)
+    std = torch.tensor([float(c['std']) for c in norm_cfg], device=data.device, dtype=data.dtype).view(shape)
+    return torch.addcmul(mean, data, std)
+
+
+def _data_range(target, data_range):
+    if data_range is not None:
+        return torch.full((target.size(0),), float(data_range), device=target.device, dtype=target.dtype)
+    flat = target.reshape(target.size(0), -1)
+    return flat.max(1)[0] - flat.min(1)[0]
+
+
+def batch_mse(pred, target):
+    return (pred - target).pow(2).reshape(pred.size(0), -1).mean(1)
+
+
+def batch_psnr(pred, target, data_range=None):
+    peak = _data_range(target, data_range)
+    return 10 * torch.log10(peak.pow(2) / batch_mse(pred, target).clamp(min=1e-20))
+
+
+def batch_nmse(pred, target):
+    err = (pred - target).pow(2).reshape(pred.size(0), -1).sum(1)
+    return err / target.pow(2).reshape(target.size(0), -1).sum(1).clamp(min=1e-20)
+
+
+def gaussian_kernel1d(size=11, sigma=1.5, dtype=torch.float32, device=None):
+    x = torch.arange(size, dtype=dtype, device=device) - (size - 1) / 2.
+    kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+    return kernel / kernel.sum()
+
+
+def _separable_filter(x, kernel):
+    c = x.size(1)
+    x = F.conv2d(x, kernel.view(1, 1, -1, 1).expand(c, 1, -1, 1), groups=c)
+    return F.conv2d(x, kernel.view(1, 1, 1, -1).expand(c, 1, 1, -1), groups=c)
+
+
+def batch_ssim(pred, target, data_range=None, win_size=11, sigma=1.5, k1=0.01, k2=0.03):
+    pred, target = pred.float(), target.float()
+    peak = _data_range(target, data_range).view(-1, 1, 1, 1)
+    c1, c2 = (k1 * peak) ** 2, (k2 * peak) ** 2
+
+    # the five local moments in one grouped pass
+    n, c = pred.shape[:2]
+    kernel = gaussian_kernel1d(win_size, sigma, pred.dtype, pred.device)
+    stats = _separable_filter(torch.cat([pred, target, pred * pred, target * target, pred * target], 1), kernel)
+    mu_p, mu_t, pp, tt, pt = stats.split(c, 1)
+
+    var_p, var_t, cov = pp - mu_p * mu_p, tt - mu_t * mu_t, pt - mu_p * mu_t
+    ssim = ((2 * mu_p * mu_t + c1) * (2 * cov + c2)) / ((mu_p * mu_p + mu_t * mu_t + c1) * (var_p + var_t + c2))
+    return ssim.reshape(n, -1).mean(1)
+
+
+def batch_metrics(pred, target, data_range=None, win_size=11):
+    # inputs whose shorter side is below the ssim window only get psnr / nmse
+    metrics = dict(psnr=batch_psnr(pred, target, data_range), nmse=batch_nmse(pred, target))
+    if min(pred.shape[-2:]) >= win_size:
+        metrics['ssim'] = batch_ssim(pred, target, data_range, win_size)
+    return metrics
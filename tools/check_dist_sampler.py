@@ -0,0 +1,106 @@
+import sys
+import torch
+import argparse
+import numpy as np
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from datasets.loader import build_dataloader, BucketBatchSampler, DistributedSampler
+
+'''
+Launches `world_size` local processes on the gloo backend and checks that
+the rank shards of every sampler cover the dataset exactly once.
+'''
+
+
+class IndexDataset(object):
+
+    def __init__(self, num_samples):
+        self.num_samples = num_samples
+        shapes = np.array([[512, 512], [1024, 1024], [2048, 2500], [3000, 3000]])
+        self.shapes = shapes[np.random.RandomState(0).randint(len(shapes), size=num_samples)]
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        return dict(index=idx)
+
+    def get_img_shapes(self):
+        return self.shapes
+
+
+def gather_indices(inds):
+    # all_gather needs equal sizes, pad with -1
+    length = torch.tensor([len(inds)])
+    lengths = [torch.zeros_like(length) for _ in range(dist.get_world_size())]
+    dist.all_gather(lengths, length)
+
+    max_length = max(int(v) for v in lengths)
+    local = torch.full((max_length,), -1, dtype=torch.int64)
+    local[:len(inds)] = torch.tensor(inds, dtype=torch.int64)
+    gathered = [torch.zeros_like(local) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, local)
+    return [g[:int(n)].tolist() for g, n in zip(gathered, lengths)]
+
+
+def gather_steps(steps):
+    steps = torch.tensor([steps])
+    gathered = [torch.zeros_like(steps) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, steps)
+    return [int(v) for v in gathered]
+
+
+def check(name, shards, steps, num_samples, pad):
+    counts = np.bincount(np.concatenate([np.array(s, dtype=np.int64) for s in shards]), minlength=num_samples)
+    if pad:
+        # padded: every rank runs the same number of steps
+        assert counts.min() >= 1, '{}: samples missing'.format(name)
+        assert len(set(steps)) == 1, '{}: uneven steps {}'.format(name, steps)
+    else:
+        assert (counts == 1).all(), '{}: samples not read exactly once'.format(name)
+    print('{}: ok, steps {}, samples {}'.format(name, steps, [len(s) for s in shards]))
+
+
+def run(rank, world_size, port, num_samples, batch_size):
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+                            rank=rank, world_size=world_size)
+    dataset = IndexDataset(num_samples)
+
+    for epoch in range(2):
+        for pad in (False, True):
+            samplers = [
+                ('DistributedSampler(pad={})'.format(pad),
+                 DistributedSampler(dataset, world_size, rank, pad=pad)),
+                ('BucketBatchSampler(pad={})'.format(pad),
+                 BucketBatchSampler(dataset, batch_size, num_replicas=world_size, rank=rank, pad=pad)),
+            ]
+            for name, sampler in samplers:
+                sampler.set_epoch(epoch)
+                items = list(sampler)
+                inds = [i for item in items for i in (item if isinstance(item, list) else [item])]
+                shards, steps = gather_indices(inds), gather_steps(len(items))
+                assert steps[rank] == len(sampler), '{}: __len__ mismatch'.format(name)
+                if rank == 0:
+                    check('epoch {} {}'.format(epoch, name), shards, steps, num_samples, pad)
+
+        data_loader = build_dataloader(dataset, batch_size, 0, dist=True, device='cpu',
+                                       bucket_cfg=dict(size_divisor=32))
+        data_loader.batch_sampler.set_epoch(epoch)
+        batches = [batch['index'].tolist() for batch in data_loader]
+        shards, steps = gather_indices([i for batch in batches for i in batch]), gather_steps(len(batches))
+        if rank == 0:
+            check('epoch {} build_dataloader(dist=True)'.format(epoch), shards, steps, num_samples, True)
+
+    dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check distributed sampler sharding')
+    parser.add_argument('--world-size', type=int, default=4)
+    parser.add_argument('--num-samples', type=int, default=1001)
+    parser.add_argument('--batch-size', type=int, default=3)
+    parser.add_argument('--port', type=int, default=29511)
+    args = parser.parse_args()
+
+    mp.spawn(run, args=(args.world_size, args.port, args.num_samples, args.batch_size), nprocs=args.world_size)
+    sys.exit(0)
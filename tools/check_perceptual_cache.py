@@ -0,0 +1,39 @@
+import sys
+import argparse
+import tempfile
+import torch
+from utils.losses import PerceptualLoss
+
+'''
+Runs `PerceptualLoss` with a target feature cache over batches that miss, hit
+partially and hit fully, and checks every loss against the uncached one.
+'''
+
+
+def check(name, loss, ref, batch, inds):
+    fake, real = batch['fake'][inds], batch['real'][inds]
+    data_meta = dict(filename=[batch['filename'][i] for i in inds])
+    value, expected = loss(fake, real, data_meta), ref(fake, real)
+    assert torch.allclose(value, expected, rtol=1e-4, atol=1e-6), '{}: {} != {}'.format(name, value, expected)
+    print('{}: ok, loss {:.6f}'.format(name, value.item()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check the perceptual loss target cache')
+    parser.add_argument('--net', default='vgg19')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--size', type=int, default=64)
+    parser.add_argument('--disk', action='store_true', help='cache under a temporary directory')
+    args = parser.parse_args()
+
+    cache_dir = tempfile.mkdtemp() if args.disk else None
+    ref = PerceptualLoss(args.net, device=args.device)
+    loss = PerceptualLoss(args.net, device=args.device, cache_cfg=dict(key_fields=('filename',), cache_dir=cache_dir))
+
+    batch = dict(fake=torch.rand(4, 1, args.size, args.size, device=args.device),
+                 real=torch.rand(4, 1, args.size, args.size, device=args.device),
+                 filename=['{}.dcm'.format(i) for i in range(4)])
+    check('miss', loss, ref, batch, [0, 1])
+    check('partial hit', loss, ref, batch, [1, 2, 0, 3])
+    check('hit', loss, ref, batch, [3, 2, 1, 0])
+    sys.exit(0)
@@ -0,0 +1,52 @@
+import sys
+import argparse
+import numpy as np
+from datasets import ShardDataset
+
+'''
+Reads every sampled index of a packed `index.json` twice through a pipeline
+that writes into the slice in place, and checks that the shard bytes are
+unchanged and that both reads (same seed) produce the same sample.
+'''
+
+
+def build_pipeline(native):
+    return [
+        dict(type='LoadDicomFromFile', to_float32=not native),
+        dict(type='TargetFromRepair'),
+        dict(type='NormalizeInstance'),
+    ]
+
+
+def read(dataset, idx, seed):
+    np.random.seed(seed)
+    results = dataset.prepare_train(idx)
+    return results['input'], results['target']
+
+
+def check(dataset, idx):
+    view = dataset.load_slice(idx)
+    assert not view.flags.writeable, '{}: shard view is writable'.format(idx)
+    before = np.array(view)
+
+    first = read(dataset, idx, idx)
+    second = read(dataset, idx, idx)
+    assert np.array_equal(dataset.load_slice(idx), before), '{}: shard bytes changed'.format(idx)
+    for a, b in zip(first, second):
+        assert np.array_equal(a, b), '{}: second read differs'.format(idx)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='check that shard reads are repeatable')
+    parser.add_argument('ann_file', help='index.json written by pack_shards.py')
+    parser.add_argument('--num-samples', type=int, default=16)
+    parser.add_argument('--native', action='store_true', help='the shards were packed with `--native`')
+    args = parser.parse_args()
+
+    dataset = ShardDataset(args.ann_file, None, build_pipeline(args.native))
+    num_samples = min(args.num_samples, len(dataset))
+    inds = np.random.RandomState(0).choice(len(dataset), num_samples, replace=False)
+    for idx in inds.tolist():
+        check(dataset, idx)
+    print('{} indices read twice: ok'.format(num_samples))
+    sys.exit(0)
@@ -0,0 +1,186 @@
+import os
+import copy
+import json
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import mmcv
+from datasets import DATASETS
+from models import MODELS
+from utils import build_from_cfg
+
+'''
+Export a model registered in `MODELS` for cpu inference, into `out_dir`:
+    fp32.pt           torch.jit.trace of `forward_test`
+    fp32.onnx         the same graph as onnx (pip install onnx)
+    int8_dynamic.pt   dynamic quantization, weights of Linear layers only; skipped
+                      (and reported so) for models without any, e.g. all-conv nets
+    int8_static.pt    FX graph mode static quantization, observers calibrated
+                      on `--num-calib` samples of the config's `test` dataset
+    report.json       latency and error of every variant against eager fp32
+
+Serve an export with `deploy_cfg` in the config, see models/deploy.py.
+'''
+
+
+class TestWrapper(nn.Module):
+
+    def __init__(self, model):
+        super(TestWrapper, self).__init__()
+        self.model = model
+
+    def forward(self, input):
+        return self.model.forward_test(input)
+
+
+def load_samples(cfg, num_samples, seed=0):
+    dataset = build_from_cfg(cfg.data.test, DATASETS)
+    inds = np.random.RandomState(seed).permutation(len(dataset))[:num_samples]
+    return [dataset[int(i)]['input'][None].float() for i in inds]
+
+
+def export_torchscript(module, example, filename):
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example)
+    if hasattr(torch.jit, 'freeze'):
+        traced = torch.jit.freeze(traced)
+    traced.save(filename)
+    return traced
+
+
+def export_onnx(module, example, filename, opset_version=13):
+    dynamic_axes = {'input': {0: 'n', 2: 'h', 3: 'w'}, 'output': {0: 'n', 2: 'h', 3: 'w'}}
+    torch.onnx.export(module, example, filename, input_names=['input'], output_names=['output'],
+                      dynamic_axes=dynamic_axes, opset_version=opset_version)
+
+
+# the layer types dynamic quantization converts
+DYNAMIC_TYPES = (nn.Linear,)
+
+
+def quantize_dynamic(module):
+    return torch.quantization.quantize_dynamic(copy.deepcopy(module), set(DYNAMIC_TYPES), dtype=torch.qint8)
+
+
+def quantize_static(module, samples, backend='fbgemm'):
+    from torch.quantization import get_default_qconfig
+    from torch.quantization.quantize_fx import prepare_fx, convert_fx
+
+    torch.backends.quantized.engine = backend
+    qconfig_dict = {'': get_default_qconfig(backend)}
+    try:
+        prepared = prepare_fx(copy.deepcopy(module), qconfig_dict, example_inputs=(samples[0],))
+    except TypeError:
+        prepared = prepare_fx(copy.deepcopy(module), qconfig_dict)  # before example_inputs existed
+
+    with torch.no_grad():
+        for sample in samples:
+            prepared(sample)
+    return convert_fx(prepared)
+
+
+def run_samples(fn, samples, warmup=2):
+    outputs, times = [], []
+    with torch.no_grad():
+        for sample in samples[:warmup]:
+            fn(sample)
+        for sample in samples:
+            start = time.perf_counter()
+            outputs.append(fn(sample))
+            times.append(time.perf_counter() - start)
+    return outputs, float(np.median(times) * 1000)
+
+
+def compare(refs, outputs):
+    max_abs, psnrs = 0., []
+    for ref, out in zip(refs, outputs):
+        err = (out.float() - ref.float()).abs()
+        max_abs = max(max_abs, err.max().item())
+        peak = (ref.max() - ref.min()).item() or 1.
+        mse = err.pow(2).mean().item()
+        psnrs.append(10 * np.log10(peak ** 2 / mse) if mse > 0 else float('inf'))
+    return dict(max_abs_err=max_abs, psnr_vs_fp32=float(np.mean(psnrs)))
+
+
+def export(cfg, checkpoint, out_dir, formats, num_calib=32, num_eval=16, backend='fbgemm'):
+    os.makedirs(out_dir, exist_ok=True)
+
+    model = build_from_cfg(cfg.model, MODELS, dict(test_cfg=cfg.get('test_cfg')))
+    state_dict = torch.load(checkpoint, map_location='cpu')
+    model.load_state_dict(state_dict.get('state_dict', state_dict))
+    module = TestWrapper(model).eval()
+
+    samples = load_samples(cfg, num_calib + num_eval)
+    calib, evals = samples[:num_calib], samples[num_calib:] or samples
+
+    refs, latency = run_samples(module, evals)
+    report = dict(eager_fp32=dict(latency_ms=latency))
+
+    variants = []
+    if 'torchscript' in formats:
+        variants.append(('fp32.pt', lambda: export_torchscript(module, evals[0], os.path.join(out_dir, 'fp32.pt'))))
+    if 'dynamic' in formats:
+        if any(isinstance(m, DYNAMIC_TYPES) for m in module.modules()):
+            variants.append(('int8_dynamic.pt', lambda: export_torchscript(
+                quantize_dynamic(module), evals[0], os.path.join(out_dir, 'int8_dynamic.pt'))))
+        else:
+            report['int8_dynamic.pt'] = dict(skipped='no {} layers, the model would stay fp32'.format(
+                '/'.join(t.__name__ for t in DYNAMIC_TYPES)))
+    if 'static' in formats:
+        variants.append(('int8_static.pt', lambda: export_torchscript(
+            quantize_static(module, calib, backend), evals[0], os.path.join(out_dir, 'int8_static.pt'))))
+
+    for name, build in variants:
+        try:
+            exported = build()
+        except Exception as e:
+            report[name] = dict(error='{}: {}'.format(type(e).__name__, e))
+            continue
+        outputs, latency = run_samples(exported, evals)
+        report[name] = dict(compare(refs, outputs), latency_ms=latency)
+
+    if 'onnx' in formats:
+        filename = os.path.join(out_dir, 'fp32.onnx')
+        try:
+            export_onnx(module, evals[0], filename)
+            from models.deploy import OnnxModel
+            onnx_model = OnnxModel(filename)
+            outputs, latency = run_samples(onnx_model.forward_test, evals)
+            report['fp32.onnx'] = dict(compare(refs, outputs), latency_ms=latency)
+        except ImportError as e:
+            report['fp32.onnx'] = dict(error=str(e), exported=os.path.exists(filename))
+        except Exception as e:
+            report['fp32.onnx'] = dict(error='{}: {}'.format(type(e).__name__, e))
+
+    with open(os.path.join(out_dir, 'report.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print('{:<18}{:>12}{:>14}{:>14}'.format('variant', 'latency ms', 'max abs err', 'psnr vs fp32'))
+    for name, r in report.items():
+        if 'error' in r or 'skipped' in r:
+            print('{:<18}  {}'.format(name, r.get('error') or 'skipped: ' + r['skipped']))
+            continue
+        print('{:<18}{:>12.2f}{:>14.4g}{:>14.2f}'.format(
+            name, r['latency_ms'], r.get('max_abs_err', 0.), r.get('psnr_vs_fp32', float('inf'))))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='export a model to torchscript / onnx / int8')
+    parser.add_argument('config')
+    parser.add_argument('checkpoint')
+    parser.add_argument('out_dir')
+    parser.add_argument('--formats', nargs='+', default=['torchscript', 'onnx', 'dynamic', 'static'],
+                        choices=['torchscript', 'onnx', 'dynamic', 'static'])
+    parser.add_argument('--num-calib', type=int, default=32, help='test samples to calibrate static int8 on')
+    parser.add_argument('--num-eval', type=int, default=16, help='test samples for the report')
+    parser.add_argument('--backend', default='fbgemm', help='quantized engine, fbgemm (x86) or qnnpack (arm)')
+    parser.add_argument('--threads', type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    export(mmcv.Config.fromfile(args.config), args.checkpoint, args.out_dir, args.formats,
+           args.num_calib, args.num_eval, args.backend)
@@ -0,0 +1,294 @@
+import os
+import sys
+import time
+import uuid
+import queue
+import argparse
+import threading
+import traceback
+import numpy as np
+import torch
+import mmcv
+import SimpleITK as sitk
+from concurrent.futures import ThreadPoolExecutor
+from datasets.pipelines import Compose, BatchCompose
+from datasets.loader.build_loader import default_collate
+from models import MODELS
+from utils import build_from_cfg
+from pretty_dataset import get_series_ids, get_series_files
+
+'''
+Enhance every DICOM series under `input_dir` into the same tree under `output_dir`.
+
+Three stages connected by bounded queues, so at most `queue_size` slices
+are held per stage:
+    read: a thread pool runs `test_pipeline` (plus `test_batch_pipeline` if the
+          config has one) on each slice, in series order
+    forward: the main thread collates `batch_size` slices, runs the model and
+             undoes `norm_cfg`; with `tile_cfg` the batch stays on the cpu and
+             only the tiles in flight go to the model's device
+    write: one thread clips to the stored pixel range and writes the slice
+           with the metadata of the original file, as a DERIVED image with
+           new instance and series UIDs (one new series per source series)
+The first error in any stage stops all of them and is raised from `run`.
+'''
+
+_STOP = object()
+
+
+def iter_series(input_dir):
+    for data_dir, _, files in sorted(os.walk(input_dir)):
+        if not files:
+            continue
+        for series_id in get_series_ids(data_dir):
+            yield data_dir, series_id, get_series_files(data_dir, series_id)
+
+
+def iter_slices(input_dir, output_dir):
+    for data_dir, series_id, files in iter_series(input_dir):
+        out_dir = os.path.join(output_dir, os.path.relpath(data_dir, input_dir), series_id)
+        for filename in files:
+            name = os.path.basename(filename)
+            if not name.endswith('.dcm'):
+                name += '.dcm'
+            yield filename, os.path.join(out_dir, name)
+
+
+def new_uid():
+    # UUID-derived UID (ISO/IEC 9834-8), needs no registered root
+    return '2.25.{}'.format(uuid.uuid4().int)
+
+
+def write_dicom(src_file, out_file, data, series_uids=None):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(src_file)
+    reader.ReadImageInformation()
+
+    # clip to what the stored pixels can hold, GDCM undoes slope/intercept on write
+    keys = reader.GetMetaDataKeys()
+    tag = lambda key, default: reader.GetMetaData(key).strip() if key in keys else default
+    slope, intercept = float(tag('0028|1053', 1.)), float(tag('0028|1052', 0.))
+    bits = int(tag('0028|0101', 16))
+    lo, hi = (-(1 << (bits - 1)), (1 << (bits - 1)) - 1) if tag('0028|0103', '0') == '1' else (0, (1 << bits) - 1)
+    lo, hi = sorted((lo * slope + intercept, hi * slope + intercept))
+
+    image = sitk.GetImageFromArray(np.clip(data, lo, hi).astype(np.float32)[None])
+    image.SetOrigin(reader.GetOrigin())
+    image.SetSpacing(reader.GetSpacing())
+    image.SetDirection(reader.GetDirection())
+    for key in keys:
+        image.SetMetaData(key, reader.GetMetaData(key))
+
+    # the output must not collide with the original slice in a PACS
+    series_uids = {} if series_uids is None else series_uids
+    src_series = tag('0020|000e', '')
+    if src_series not in series_uids:
+        series_uids[src_series] = new_uid()
+    sop_uid = new_uid()
+    image.SetMetaData('0020|000e', series_uids[src_series])
+    image.SetMetaData('0008|0018', sop_uid)
+    if '0002|0003' in keys:
+        image.SetMetaData('0002|0003', sop_uid)
+    image_type = tag('0008|0008', 'ORIGINAL\\PRIMARY').split('\\')
+    image.SetMetaData('0008|0008', '\\'.join(['DERIVED', 'SECONDARY'] + image_type[2:]))
+
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    writer = sitk.ImageFileWriter()
+    writer.KeepOriginalImageUIDOn()
+    writer.SetFileName(out_file)
+    writer.Execute(image)
+
+
+class SeriesInference(object):
+
+    def __init__(self, model, pipeline, batch_pipeline=None, device='cuda', batch_size=8, read_workers=4,
+                 queue_size=32):
+        self.model = model
+        self.pipeline = pipeline
+        self.batch_pipeline = batch_pipeline
+        self.device = device
+        self.batch_size = batch_size
+        self.read_workers = read_workers
+        self.queue_size = queue_size
+
+        self.stop = threading.Event()
+        self.errors = []
+        # source series uid -> uid of the derived series, used by the writer thread only
+        self.series_uids = {}
+
+    def _fail(self, stage):
+        self.errors.append('{} failed:\n{}'.format(stage, traceback.format_exc()))
+        self.stop.set()
+
+    def _read(self, filename):
+        results = dict(data_root=None, img_info=dict(filename=filename),
+                       ann_info=dict(boxes=np.zeros((0, 4), dtype=np.float32), masks=[]))
+        data = self.pipeline(results)
+        if data is None:
+            raise ValueError('{}: test pipeline returned None'.format(filename))
+        return data
+
+    def _reader(self, slices, read_queue):
+        try:
+            pending = queue.Queue()
+            with ThreadPoolExecutor(self.read_workers) as pool:
+                for src_file, out_file in slices:
+                    if self.stop.is_set():
+                        break
+                    pending.put((src_file, out_file, pool.submit(self._read, src_file)))
+                    # keep `queue_size` reads in flight, hand over in submission order
+                    while pending.qsize() >= self.queue_size:
+                        self._put(read_queue, self._done(pending.get()))
+                while not pending.empty() and not self.stop.is_set():
+                    self._put(read_queue, self._done(pending.get()))
+                while not pending.empty():
+                    pending.get()[2].cancel()
+        except Exception:
+            self._fail('read')
+        self._put(read_queue, _STOP)
+
+    def _done(self, item):
+        src_file, out_file, future = item
+        return src_file, out_file, future.result()
+
+    def _put(self, q, item):
+        # gives up once stopped, consumers then see an empty queue as the end
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def _get(self, q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return _STOP
+
+    def _writer(self, write_queue):
+        try:
+            while True:
+                item = self._get(write_queue)
+                if item is _STOP:
+                    break
+                write_dicom(*item, series_uids=self.series_uids)
+                self.num_written += 1
+        except Exception:
+            self._fail('write')
+
+    def _forward(self, batch):
+        items = [item[2] for item in batch]
+        data = default_collate(items)
+        if self.batch_pipeline is not None:
+            data = self.batch_pipeline(data)
+
+        input = data['input']
+        if not self.model.test_cfg.get('tile_cfg'):
+            input = input.to(self.device)
+        with torch.no_grad():
+            output = self.model(input, None, data['data_meta'], return_loss=False)
+        output = output.float().cpu().numpy()
+
+        data_meta = data['data_meta']
+        for i, (src_file, out_file, _) in enumerate(batch):
+            h, w = data_meta['ori_shape'][i][:2]
+            pred = output[i, 0, :h, :w]
+            norm_cfg = data_meta.get('norm_cfg')
+            if norm_cfg is not None:
+                pred = pred * float(norm_cfg[i]['std']) + float(norm_cfg[i]['mean'])
+            yield src_file, out_file, pred
+
+    def run(self, slices, log_interval=100):
+        read_queue = queue.Queue(self.queue_size)
+        write_queue = queue.Queue(self.queue_size)
+        self.num_written = 0
+
+        reader = threading.Thread(target=self._reader, args=(slices, read_queue), daemon=True)
+        writer = threading.Thread(target=self._writer, args=(write_queue,), daemon=True)
+        reader.start()
+        writer.start()
+
+        start, num_slices, last_log = time.time(), 0, 0
+        batch = []
+        try:
+            while not self.stop.is_set():
+                item = self._get(read_queue)
+                if item is not _STOP:
+                    batch.append(item)
+                if batch and (item is _STOP or len(batch) == self.batch_size):
+                    for result in self._forward(batch):
+                        self._put(write_queue, result)
+                    num_slices += len(batch)
+                    batch = []
+                if item is _STOP:
+                    break
+
+                if num_slices - last_log >= log_interval:
+                    last_log = num_slices
+                    print('{} slices, {:.1f} slices/sec'.format(num_slices, num_slices / (time.time() - start)))
+        except Exception:
+            self._fail('forward')
+        except KeyboardInterrupt:
+            self.errors.append('interrupted')
+            self.stop.set()
+
+        self._put(write_queue, _STOP)
+        writer.join()
+        self.stop.set()
+        reader.join()
+
+        elapsed = time.time() - start
+        print('{} slices written in {:.1f}s, {:.1f} slices/sec'.format(
+            self.num_written, elapsed, self.num_written / max(elapsed, 1e-6)))
+        if self.errors:
+            raise RuntimeError('\n'.join(self.errors))
+
+
+def build_model(cfg, checkpoint, device):
+    # with `deploy_cfg` the checkpoint is an export of tools/export_model.py
+    if cfg.get('deploy_cfg'):
+        model = build_from_cfg(cfg.deploy_cfg, MODELS, dict(file=checkpoint, test_cfg=cfg.get('test_cfg')))
+        return model.eval()
+
+    model = build_from_cfg(cfg.model, MODELS, dict(test_cfg=cfg.get('test_cfg')))
+    state_dict = torch.load(checkpoint, map_location='cpu')
+    model.load_state_dict(state_dict.get('state_dict', state_dict))
+    return model.to(device).eval()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='enhance a directory tree of dicom series')
+    parser.add_argument('config')
+    parser.add_argument('checkpoint')
+    parser.add_argument('input_dir')
+    parser.add_argument('output_dir')
+    parser.add_argument('--device', default='cuda')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--read-workers', type=int, default=4)
+    parser.add_argument('--queue-size', type=int, default=32, help='slices buffered between stages')
+    parser.add_argument('--log-interval', type=int, default=100)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    cfg = mmcv.Config.fromfile(args.config)
+
+    model = build_model(cfg, args.checkpoint, args.device)
+    pipeline = Compose(cfg.test_pipeline)
+    batch_pipeline = BatchCompose(cfg.test_batch_pipeline) if cfg.get('test_batch_pipeline') else None
+
+    engine = SeriesInference(model, pipeline, batch_pipeline, args.device, args.batch_size, args.read_workers,
+                             args.queue_size)
+    try:
+        engine.run(iter_slices(args.input_dir, args.output_dir), args.log_interval)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import os
+import json
+import argparse
+from datasets.pipelines.loading import read_dicom
+
+'''
+Pack a COCO json and its DICOMs into a few large shard files.
+
+out_dir/shard_000.bin: contiguous pixel data
+out_dir/index.json: the COCO json, every image entry extended with
+    `shard`, `offset`, `shape` and `dtype` of its slice, and `rescale`
+    (slope/intercept) when packed with `--native`
+
+The index is still a valid COCO json, it is served by `ShardDataset`.
+'''
+
+ALIGNMENT = 64
+
+
+def pack_shards(ann_file, data_root, output_dir, shard_size=1 << 30, native=False):
+    with open(ann_file, 'r') as f:
+        coco = json.load(f)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    shards = []
+    shard_file, offset = None, 0
+    for img in coco['images']:
+        if shard_file is None or offset >= shard_size:
+            if shard_file is not None:
+                shard_file.close()
+            shards.append('shard_{:03d}.bin'.format(len(shards)))
+            shard_file = open(os.path.join(output_dir, shards[-1]), 'wb')
+            offset = 0
+
+        data, rescale = read_dicom(os.path.join(data_root, img['file_name']), to_float32=not native)
+        shard_file.write(data.tobytes())
+        if rescale is not None:
+            img['rescale'] = rescale
+
+        img['shard'] = shards[-1]
+        img['offset'] = offset
+        img['shape'] = list(data.shape)
+        img['dtype'] = data.dtype.str
+
+        offset += data.nbytes
+        padding = -offset % ALIGNMENT
+        shard_file.write(b'\0' * padding)
+        offset += padding
+
+    if shard_file is not None:
+        shard_file.close()
+
+    coco['shards'] = shards
+    with open(os.path.join(output_dir, 'index.json'), 'w') as f:
+        json.dump(coco, f)
+    print('{} images -> {} shards in {}'.format(len(coco['images']), len(shards), output_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='pack a coco dataset into shard files')
+    parser.add_argument('ann_file', help='e.g. data/coco/coco_train.json')
+    parser.add_argument('data_root', help='directory the `file_name` entries are relative to')
+    parser.add_argument('output_dir')
+    parser.add_argument('--shard-size', type=int, default=1024, help='MB per shard')
+    parser.add_argument('--native', action='store_true', help='keep 16-bit stored pixels instead of float32')
+    args = parser.parse_args()
+    pack_shards(args.ann_file, args.data_root, args.output_dir, args.shard_size << 20, args.native)
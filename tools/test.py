@@ -0,0 +1,88 @@
+import json
+import time
+import argparse
+import torch
+import mmcv
+from datasets import DATASETS
+from datasets.loader import build_dataloader, batch_to_device
+from utils import Cache, build_from_cfg
+from utils.metrics import batch_metrics, denormalize
+from infer_series import build_model
+
+'''
+PSNR / SSIM / NMSE of the model output against `target` over `data.test`.
+Both are denormalized first: the output with `norm_cfg`, the target with
+`target_norm_cfg` (falls back to `norm_cfg`), so the test `Collect` needs
+meta_keys=('filename', 'ori_shape', 'norm_cfg', 'target_norm_cfg').
+`--data-range` fixes the PSNR/SSIM peak, by default it is the range of each target.
+'''
+
+
+def evaluate(model, data_loader, device, data_range=None, log_interval=50):
+    # running mean / std / min / max per metric, constant memory, sums stay on the device
+    meter = Cache()
+    start = time.time()
+    num_samples = 0
+
+    model.eval()
+    with torch.no_grad():
+        for i, batch in enumerate(data_loader):
+            batch = batch_to_device(batch, device, non_blocking=True)
+            data_meta = batch['data_meta']
+            pred = model(batch['input'], batch.get('target'), data_meta, return_loss=False).float()
+            target = batch['target'].to(pred.device).float()
+
+            if data_meta.get('norm_cfg') is not None:
+                pred = denormalize(pred, data_meta['norm_cfg'])
+            target_norm_cfg = data_meta.get('target_norm_cfg', data_meta.get('norm_cfg'))
+            if target_norm_cfg is not None:
+                target = denormalize(target, target_norm_cfg)
+
+            # padded batches (slices of different shape) are scored per sample
+            shapes = [tuple(s[:2]) for s in data_meta.get('ori_shape', [])]
+            if any(s != tuple(pred.shape[-2:]) for s in shapes):
+                for j, (h, w) in enumerate(shapes):
+                    meter.keep(**batch_metrics(pred[j:j + 1, :, :h, :w], target[j:j + 1, :, :h, :w], data_range))
+            else:
+                meter.keep(**batch_metrics(pred, target, data_range))
+
+            num_samples += pred.size(0)
+            if (i + 1) % log_interval == 0:
+                print('{}/{} batches, {:.1f} samples/sec'.format(i + 1, len(data_loader),
+                                                                  num_samples / (time.time() - start)))
+    return meter.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='evaluate a model on the test set of a config')
+    parser.add_argument('config')
+    parser.add_argument('checkpoint')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--data-range', type=float, default=None)
+    parser.add_argument('--out', help='json file for the summary')
+    args = parser.parse_args()
+
+    cfg = mmcv.Config.fromfile(args.config)
+    model = build_model(cfg, args.checkpoint, args.device)
+
+    data = dict(cfg.data)
+    dataset = build_from_cfg(data.pop('test'), DATASETS)
+    imgs_per_gpu, workers_per_gpu = data.pop('imgs_per_gpu'), data.pop('workers_per_gpu')
+    data.pop('train', None)
+    data.pop('val', None)
+    data.update(shuffle=False, device=args.device)
+    data_loader = build_dataloader(dataset, imgs_per_gpu, workers_per_gpu,
+                                   batch_pipeline=cfg.get('test_batch_pipeline'), **data)
+
+    results = evaluate(model, data_loader, args.device, args.data_range)
+    for k in sorted(results):
+        r = results[k]
+        print('{:<6} mean {:.6g} std {:.6g} min {:.6g} max {:.6g} ({} samples)'.format(
+            k, r['mean'], r['std'], r['min'], r['max'], r['count']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
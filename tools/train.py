@@ -0,0 +1,215 @@
+import os
+import time
+import shutil
+import argparse
+import torch
+from contextlib import ExitStack
+import mmcv
+from datasets import DATASETS
+from datasets.loader import build_dataloader, batch_to_device
+from models import MODELS
+from utils import Cache, build_from_cfg, get_root_logger
+
+'''
+Config keys besides model / data / pipelines:
+    optimizer = dict(type='Adam', lr=1e-4)           # any torch.optim class
+    total_epochs = 12
+    accumulate = 1                                   # batches per optimizer step
+    amp_cfg = dict(dtype='bfloat16')                 # autocast, bfloat16 on cpu; float16 adds a GradScaler
+    checkpoint_config = dict(interval=1)             # epochs
+    log_config = dict(interval=50)                   # iterations
+    work_dir = 'work_dirs/single_dcnn_r9_motion'
+    device = 'cuda'
+
+Every log window reports the mean losses, the time spent waiting for the
+loader vs. in forward/backward/step, and samples/sec. On cuda compute is
+timed with events and the device is only synchronized at the end of a log
+window, so the host keeps running ahead of the gpu in between.
+'''
+
+
+def parse_losses(losses):
+    # forward_train returns a loss tensor or a dict of named tensors, only the
+    # keys containing `loss` are summed
+    if isinstance(losses, torch.Tensor):
+        return losses, dict(loss=losses.detach())
+    loss = sum(v for k, v in losses.items() if 'loss' in k)
+    log_vars = {k: v.detach() for k, v in losses.items()}
+    log_vars['loss'] = loss.detach()
+    return loss, log_vars
+
+
+class Trainer(object):
+
+    def __init__(self, cfg, work_dir, device, logger):
+        self.cfg = cfg
+        self.work_dir = work_dir
+        self.device = torch.device(device)
+        self.logger = logger
+
+        self.model = build_from_cfg(cfg.model, MODELS, dict(test_cfg=cfg.get('test_cfg'))).to(self.device)
+        optimizer_cfg = dict(cfg.optimizer)
+        optimizer_type = optimizer_cfg.pop('type')
+        self.optimizer = getattr(torch.optim, optimizer_type)(self.model.parameters(), **optimizer_cfg)
+
+        self.accumulate = cfg.get('accumulate', 1)
+        amp_cfg = cfg.get('amp_cfg') or {}
+        self.amp_dtype = getattr(torch, amp_cfg['dtype']) if 'dtype' in amp_cfg else None
+        self.scaler = None
+        if self.amp_dtype == torch.float16 and self.device.type == 'cuda':
+            self.scaler = torch.cuda.amp.GradScaler()
+
+        self.epoch = 0
+        self.iter = 0
+
+    def build_loader(self):
+        data = dict(self.cfg.data)
+        dataset = build_from_cfg(data.pop('train'), DATASETS)
+        imgs_per_gpu, workers_per_gpu = data.pop('imgs_per_gpu'), data.pop('workers_per_gpu')
+        data.pop('val', None)
+        data.pop('test', None)
+        data.setdefault('device', self.device.type)
+        return build_dataloader(dataset, imgs_per_gpu, workers_per_gpu,
+                                batch_pipeline=self.cfg.get('train_batch_pipeline'), **data)
+
+    def _autocast(self):
+        if self.amp_dtype is None:
+            return ExitStack()
+        return torch.autocast(self.device.type, dtype=self.amp_dtype)
+
+    def train_step(self, batch, step):
+        batch = batch_to_device(batch, self.device, non_blocking=True)
+        with self._autocast():
+            losses = self.model(batch['input'], batch.get('target'), batch['data_meta'], return_loss=True)
+        loss, log_vars = parse_losses(losses)
+
+        loss = loss / self.accumulate
+        if self.scaler is not None:
+            self.scaler.scale(loss).backward()
+        else:
+            loss.backward()
+
+        if step:
+            if self.scaler is not None:
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
+            else:
+                self.optimizer.step()
+            self.optimizer.zero_grad()
+        return log_vars, batch['input'].size(0)
+
+    def train_epoch(self, data_loader, log_interval):
+        self.model.train()
+        cache = Cache()
+        use_events = self.device.type == 'cuda'
+        data_time = compute_time = 0.
+        events = []
+        num_samples = 0
+
+        window_start = end = time.perf_counter()
+        for i, batch in enumerate(data_loader):
+            fetched = time.perf_counter()
+            step = (i + 1) % self.accumulate == 0 or i + 1 == len(data_loader)
+            if use_events:
+                start, stop = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+            log_vars, batch_size = self.train_step(batch, step)
+            if use_events:
+                stop.record()
+                events.append((start, stop))
+            else:
+                compute_time += time.perf_counter() - fetched
+
+            data_time += fetched - end
+            num_samples += batch_size
+            cache.keep(**{k: v.float().mean() for k, v in log_vars.items()})
+            self.iter += 1
+
+            if (i + 1) % log_interval == 0 or i + 1 == len(data_loader):
+                # the only synchronization, events are read after it
+                if use_events:
+                    torch.cuda.synchronize(self.device)
+                    compute_time = sum(start.elapsed_time(stop) for start, stop in events) / 1000.
+                window = time.perf_counter() - window_start
+                message = 'epoch {} iter {}/{} - {}'.format(self.epoch + 1, i + 1, len(data_loader),
+                                                            cache.summary(self.iter))
+                self.logger.info('{} - data {:.3f}s ({:.0%}) compute {:.3f}s, {:.1f} samples/sec'.format(
+                    message, data_time, data_time / max(window, 1e-9), compute_time, num_samples / max(window, 1e-9)))
+                data_time = compute_time = 0.
+                events = []
+                num_samples = 0
+                window_start = time.perf_counter()
+            end = time.perf_counter()
+        self.epoch += 1
+
+    def save_checkpoint(self, filename, latest='latest.pth'):
+        checkpoint = dict(state_dict=self.model.state_dict(), optimizer=self.optimizer.state_dict(),
+                          epoch=self.epoch, iter=self.iter)
+        if self.scaler is not None:
+            checkpoint['scaler'] = self.scaler.state_dict()
+        filename = os.path.join(self.work_dir, filename)
+        torch.save(checkpoint, filename + '.tmp')
+        os.replace(filename + '.tmp', filename)
+        self.logger.info('saved {}'.format(filename))
+
+        if latest:
+            # written once, `latest` links to it (a copy where symlinks are not allowed)
+            latest = os.path.join(self.work_dir, latest)
+            tmp = latest + '.tmp'
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            try:
+                os.symlink(os.path.basename(filename), tmp)
+            except (OSError, NotImplementedError):
+                shutil.copyfile(filename, tmp)
+            os.replace(tmp, latest)
+
+    def resume(self, filename):
+        checkpoint = torch.load(filename, map_location='cpu')
+        self.model.load_state_dict(checkpoint['state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer'])
+        if self.scaler is not None and 'scaler' in checkpoint:
+            self.scaler.load_state_dict(checkpoint['scaler'])
+        self.epoch, self.iter = checkpoint['epoch'], checkpoint['iter']
+        self.logger.info('resumed from {}, epoch {}'.format(filename, self.epoch))
+
+    def run(self):
+        data_loader = self.build_loader()
+        log_interval = self.cfg.get('log_config', {}).get('interval', 50)
+        ckpt_interval = self.cfg.get('checkpoint_config', {}).get('interval', 1)
+
+        self.optimizer.zero_grad()
+        while self.epoch < self.cfg.total_epochs:
+            # shuffles from `seed + epoch`, also right after a resume
+            for name in ('batch_sampler', 'sampler'):
+                sampler = getattr(data_loader, name, None)
+                if hasattr(sampler, 'set_epoch'):
+                    sampler.set_epoch(self.epoch)
+            self.train_epoch(data_loader, log_interval)
+            if self.epoch % ckpt_interval == 0 or self.epoch == self.cfg.total_epochs:
+                self.save_checkpoint('epoch_{}.pth'.format(self.epoch))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='train a model from a config')
+    parser.add_argument('config')
+    parser.add_argument('--work-dir', help='overrides `work_dir` of the config')
+    parser.add_argument('--resume-from')
+    parser.add_argument('--device', help='overrides `device` of the config')
+    args = parser.parse_args()
+
+    cfg = mmcv.Config.fromfile(args.config)
+    work_dir = args.work_dir or cfg.get('work_dir') or os.path.join(
+        'work_dirs', os.path.splitext(os.path.basename(args.config))[0])
+    device = args.device or cfg.get('device') or ('cuda' if torch.cuda.is_available() else 'cpu')
+    os.makedirs(work_dir, exist_ok=True)
+
+    logger = get_root_logger(work_dir)
+    trainer = Trainer(cfg, work_dir, device, logger)
+    if args.resume_from:
+        trainer.resume(args.resume_from)
+    trainer.run()
+
+
+if __name__ == '__main__':
+    main()